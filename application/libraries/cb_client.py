@@ -0,0 +1,189 @@
+import importlib.util
+
+import httpx
+
+# Timeouts in seconds for each kind of CB API call. Status
+# checks should come back quickly, while file transfers and
+# the full device list may take a while.
+ENDPOINT_TIMEOUTS = {
+    'default': 180,
+    'device': 60,
+    'device_all': 300,
+    'search': 120,
+    'session': 60,
+    'command': 60,
+    'file_upload': 600,
+    'file_download': 600,
+}
+
+
+def get_http2_support():
+    '''
+    Checks if the optional 'h2' package is installed, which
+    httpx needs in order to speak HTTP/2.
+
+    :return supported:
+    '''
+
+    return importlib.util.find_spec('h2') is not None
+
+def get_limits(max_sessions):
+    '''
+    Gets the connection pool limits. The pool is sized to the
+    number of concurrent CB sessions so every worker can keep
+    its own connection alive between calls.
+
+    :param max_sessions:
+    :return limits:
+    '''
+
+    return httpx.Limits(max_connections=int(max_sessions),
+                        max_keepalive_connections=int(max_sessions))
+
+def get_timeout(endpoint):
+    '''
+    Gets the timeout for a type of CB API call.
+
+    :param endpoint:
+    :return timeout:
+    '''
+
+    return ENDPOINT_TIMEOUTS.get(endpoint, ENDPOINT_TIMEOUTS['default'])
+
+
+class CB_CLIENT():
+    '''
+    Pooled CB API client for the threaded scripts. The
+    X-Auth-Token header and the TLS connections are set up
+    once and reused by every call. A custom httpx transport
+    can be passed in, e.g. to run against a mock of the API.
+    '''
+
+    def __init__(self, root_url, xauth_token, max_sessions, http2=False, transport=None):
+        self.client = httpx.Client(base_url=root_url,
+                                   headers={'X-Auth-Token': xauth_token},
+                                   limits=get_limits(max_sessions),
+                                   http2=(http2 and get_http2_support()),
+                                   verify=False,
+                                   transport=transport)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        Closes every pooled connection.
+        '''
+
+        self.client.close()
+
+    def request(self, method, endpoint, url, **kwargs):
+        '''
+        Sends a request to the CB API using the timeout of
+        the type of call.
+
+        :param method:
+        :param endpoint:
+        :param url:
+        :return response:
+        '''
+
+        kwargs.setdefault('timeout', get_timeout(endpoint))
+
+        return self.client.request(method, url, **kwargs)
+
+    def stream(self, method, endpoint, url, **kwargs):
+        '''
+        Sends a request to the CB API without reading the body.
+        Meant to be used with 'with', the body is read through
+        the response in chunks.
+
+        :param method:
+        :param endpoint:
+        :param url:
+        :return response:
+        '''
+
+        kwargs.setdefault('timeout', get_timeout(endpoint))
+
+        return self.client.stream(method, url, **kwargs)
+
+    def get(self, endpoint, url, **kwargs):
+        return self.request('GET', endpoint, url, **kwargs)
+
+    def post(self, endpoint, url, **kwargs):
+        return self.request('POST', endpoint, url, **kwargs)
+
+    def put(self, endpoint, url, **kwargs):
+        return self.request('PUT', endpoint, url, **kwargs)
+
+
+class CB_ASYNC_CLIENT():
+    '''
+    Pooled CB API client for the asyncio sweep engine. Same
+    as CB_CLIENT, but every call has to be awaited.
+    '''
+
+    def __init__(self, root_url, xauth_token, max_sessions, http2=False, transport=None):
+        self.client = httpx.AsyncClient(base_url=root_url,
+                                        headers={'X-Auth-Token': xauth_token},
+                                        limits=get_limits(max_sessions),
+                                        http2=(http2 and get_http2_support()),
+                                        verify=False,
+                                        transport=transport)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        '''
+        Closes every pooled connection.
+        '''
+
+        await self.client.aclose()
+
+    async def request(self, method, endpoint, url, **kwargs):
+        '''
+        Sends a request to the CB API using the timeout of
+        the type of call.
+
+        :param method:
+        :param endpoint:
+        :param url:
+        :return response:
+        '''
+
+        kwargs.setdefault('timeout', get_timeout(endpoint))
+
+        return await self.client.request(method, url, **kwargs)
+
+    def stream(self, method, endpoint, url, **kwargs):
+        '''
+        Sends a request to the CB API without reading the body.
+        Meant to be used with 'with', the body is read through
+        the response in chunks.
+
+        :param method:
+        :param endpoint:
+        :param url:
+        :return response:
+        '''
+
+        kwargs.setdefault('timeout', get_timeout(endpoint))
+
+        return self.client.stream(method, url, **kwargs)
+
+    async def get(self, endpoint, url, **kwargs):
+        return await self.request('GET', endpoint, url, **kwargs)
+
+    async def post(self, endpoint, url, **kwargs):
+        return await self.request('POST', endpoint, url, **kwargs)
+
+    async def put(self, endpoint, url, **kwargs):
+        return await self.request('PUT', endpoint, url, **kwargs)
@@ -0,0 +1,164 @@
+import random
+import sys
+
+# Longest wait in seconds between two status checks for each
+# phase of a host. None of them goes above the interval of the
+# fixed strategy, so a long phase is never checked more often
+# than it used to be.
+PHASE_CEILINGS = {
+    'session': 5,
+    'command': 5,
+    'put_file': 5,
+    'get_file': 5,
+}
+
+
+class FIXED_POLLING():
+    '''
+    Polls every 'interval' seconds until 'waiting_period'
+    runs out. This is how the sweeper has always polled.
+    '''
+
+    def __init__(self, waiting_period, interval=5):
+        self.waiting_period = waiting_period
+        self.interval = interval
+
+    def get_delays(self, phase):
+        '''
+        Gets the seconds to sleep before each status check.
+
+        :param phase:
+        :return delays:
+        '''
+        count = 0
+
+        while count < self.waiting_period:
+            yield self.interval
+            count += self.interval
+
+
+class BACKOFF_POLLING():
+    '''
+    Polls quickly the first time, then backs off exponentially
+    with some jitter, up to the ceiling of the phase, until
+    'waiting_period' runs out.
+    '''
+
+    def __init__(self, waiting_period, first_delay=0.3, factor=2, jitter=0.2, ceilings=PHASE_CEILINGS):
+        self.waiting_period = waiting_period
+        self.first_delay = first_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.ceilings = ceilings
+
+    def get_delays(self, phase):
+        '''
+        Gets the seconds to sleep before each status check.
+
+        :param phase:
+        :return delays:
+        '''
+        count = 0
+        delay = self.first_delay
+        ceiling = self.ceilings.get(phase, max(self.ceilings.values()))
+
+        while count < self.waiting_period:
+            # Jitter keeps hosts that started together from
+            # polling the API all at the same time.
+            wait = min(delay, ceiling) * random.uniform(1 - self.jitter, 1 + self.jitter)
+            wait = min(wait, self.waiting_period - count)
+
+            yield wait
+            count += wait
+            delay *= self.factor
+
+
+def get_polling_strategy(name, waiting_period, interval):
+    '''
+    Gets the polling strategy by name. Anything other
+    than 'fixed' uses the backoff strategy.
+
+    :param name:
+    :param waiting_period:
+    :param interval:
+    :return strategy:
+    '''
+
+    if name == 'fixed':
+        return FIXED_POLLING(waiting_period, interval)
+
+    return BACKOFF_POLLING(waiting_period)
+
+def get_time_to_detect(strategy, phase, finished):
+    '''
+    Gets the seconds it takes a strategy to notice that a
+    phase which took 'finished' seconds in CB is done.
+
+    :param strategy:
+    :param phase:
+    :param finished:
+    :return seconds:
+    '''
+    count = 0
+
+    for delay in strategy.get_delays(phase):
+        count += delay
+
+        if count >= finished:
+            return count
+
+    return count
+
+def benchmark(hosts=10000, waiting_period=200, interval=5):
+    '''
+    Simulates a type 1 sweep (session, command, get file) on
+    'hosts' hosts and prints the average wall-clock time per
+    host for the fixed interval and the backoff strategy.
+
+    :param hosts:
+    :param waiting_period:
+    :param interval:
+    '''
+
+    # Rough time in seconds that CB takes to finish each
+    # phase. Most commands finish in well under a second.
+    phase_times = {
+        'session': lambda: random.uniform(0.5, 30),
+        'command': lambda: random.uniform(0.2, 3),
+        'get_file': lambda: random.uniform(0.2, 2),
+    }
+
+    random.seed(0)
+    hosts_phases = [{phase: get_time() for phase, get_time in phase_times.items()} for i in range(hosts)]
+
+    strategies = {
+        'fixed': FIXED_POLLING(waiting_period, interval),
+        'backoff': BACKOFF_POLLING(waiting_period),
+    }
+
+    results = dict()
+
+    for name, strategy in strategies.items():
+        total = 0
+
+        for phases in hosts_phases:
+            for phase, finished in phases.items():
+                total += get_time_to_detect(strategy, phase, finished)
+
+        results[name] = total / hosts
+
+    actual = sum(sum(phases.values()) for phases in hosts_phases) / hosts
+
+    print("[*] Simulated hosts: {}".format(hosts))
+    print("[*] Time spent in CB per host: {:.2f}s".format(actual))
+
+    for name, seconds in results.items():
+        print("[*] {:<8} {:.2f}s per host ({:.2f}s of dead time)".format(name, seconds, seconds - actual))
+
+    print("[*] Backoff saves {:.2f}s per host.".format(results['fixed'] - results['backoff']))
+
+if __name__ == '__main__':
+    try:
+        benchmark(int(sys.argv[1]))
+    except IndexError:
+        benchmark()
@@ -0,0 +1,138 @@
+import asyncio
+import json
+
+
+class SEARCH_BOT():
+    '''
+    Runs the query of a search sweep against the CB process or
+    event search API. The first page gives the total number of
+    results, then every other page is fetched in parallel, up
+    to 'max_results'. If the query has more results than that,
+    'truncated' is set once the search is done.
+    '''
+
+    def __init__(self, client, search_type, query, concurrency, page_size=1000, max_results=10000, window='2w'):
+        self.client = client
+        self.search_type = search_type
+        self.query = query
+        self.page_slots = asyncio.Semaphore(concurrency)
+        self.page_size = page_size
+        self.max_results = max_results
+        self.window = window
+        self.total = 0
+        self.truncated = False
+
+    async def get_page(self, start):
+        '''
+        Gets one page of search results.
+
+        :param start:
+        :return results:
+        '''
+
+        # Variables used for the GET request.
+        request_url = '/integrationServices/v3/{}'.format(self.search_type)
+
+        params = {'query': self.query,
+                  'searchWindow': self.window,
+                  'start': start,
+                  'rows': self.page_size}
+
+        async with self.page_slots:
+            response = await self.client.get('search', request_url, params=params)
+
+        # Check if it was a valid response.
+        if response.status_code == 200:
+            results = json.loads((response.content).decode())
+
+            if results.get('success') == True:
+                return results
+
+        print("[*] {} search page at {} failed: {}".format(self.search_type, start, response.status_code))
+
+        return False
+
+    async def search(self):
+        '''
+        Gets every result of the query.
+
+        :return results:
+        '''
+        first_page = await self.get_page(0)
+
+        if first_page == False:
+            return False
+
+        self.total = int(first_page.get('totalResults', 0))
+        self.truncated = self.total > self.max_results
+
+        total = min(self.total, self.max_results)
+
+        pages = await asyncio.gather(*[self.get_page(start) for start in range(self.page_size, total, self.page_size)])
+
+        if False in pages:
+            return False
+
+        results = list()
+
+        for page in [first_page] + pages:
+            results += page.get('results', [])
+
+        return results[:self.max_results]
+
+    @staticmethod
+    def get_device_id(result):
+        '''
+        Gets the device of a search result. Process results have
+        it at the top, event results in the device details.
+
+        :param result:
+        :return device_id:
+        '''
+        device_id = result.get('deviceId', (result.get('deviceDetails') or {}).get('deviceId'))
+
+        if device_id == None:
+            return None
+
+        return int(device_id)
+
+def group_hits(results, device_ids, hits_per_host, truncated=False):
+    '''
+    Groups the results of a search by host. Hosts without hits
+    are only reported as having none if every result was read,
+    since the missing results could be theirs.
+
+    :param results:
+    :param device_ids: hosts of the sweep.
+    :param hits_per_host: number of hits kept for each host.
+    :param truncated:
+    :return hosts: dictionary of device_id: fields of the host.
+    '''
+    hits = dict()
+
+    for result in results:
+        hits.setdefault(SEARCH_BOT.get_device_id(result), []).append(result)
+
+    hosts = dict()
+
+    for device_id in device_ids:
+        host_hits = hits.get(int(device_id), [])
+
+        if host_hits and truncated:
+            status = 'At least {} hits. Results were truncated.'.format(len(host_hits))
+
+        elif host_hits:
+            status = '{} hits.'.format(len(host_hits))
+
+        elif truncated:
+            status = 'No hits in the results read. Results were truncated.'
+
+        else:
+            status = 'No hits.'
+
+        hosts[int(device_id)] = {'status': status,
+                                 'hit_count': len(host_hits),
+                                 'hits': host_hits[:hits_per_host],
+                                 'truncated': truncated}
+
+    return hosts
@@ -0,0 +1,306 @@
+import concurrent.futures
+import datetime
+import json
+import sys
+
+import pymongo
+
+import cb_client
+
+# Database configuration
+MONGO_CLIENT = pymongo.MongoClient('127.0.0.1', 5051)
+CB_BOT_DB = MONGO_CLIENT.cb_bot
+
+# Session states that still count against the concurrent
+# session limit of CB.
+OPEN_STATES = ('ACTIVE', 'PENDING')
+
+
+class SESSION_REAPER():
+    '''
+    Closes the CB sessions that no running sweep owns anymore.
+    Sweeps that are stopped with 'kill -9' or die never get to
+    close their sessions, which then count against the session
+    limit of CB until it times them out.
+
+    Only the sessions cb-bot recorded in the lr_sessions
+    collection are considered, so sessions that analysts or
+    other tools opened are left alone. A session is owned if a
+    task that is still active holds a claim on it with a
+    heartbeat newer than 'lease_timeout' seconds, or if it was
+    released by a task that is still active less than
+    'idle_window' seconds ago.
+    '''
+
+    def __init__(self, client, lease_timeout, idle_window, max_sessions):
+        self.client = client
+        self.lease_timeout = lease_timeout
+        self.idle_window = idle_window
+        self.max_sessions = max_sessions
+
+    def get_open_sessions(self):
+        '''
+        Gets every session that is still open in CB.
+
+        :return sessions: dictionary of session_id: device_id,
+                          or None if CB could not be reached.
+        '''
+        request_url = '/integrationServices/v3/cblr/session'
+
+        try:
+            response = self.client.get('session', request_url)
+
+        except Exception as e:
+            print(e)
+            return None
+
+        if response.status_code != 200:
+            print("[!] Could not list the CB sessions: {}".format(response.status_code))
+            return None
+
+        results = json.loads(response.content.decode())
+
+        # Some versions wrap the list in 'results'.
+        if type(results) is dict:
+            results = results.get('results', [])
+
+        sessions = dict()
+
+        for session in results:
+            if str(session.get('status', '')).upper() in OPEN_STATES:
+                sessions[str(session.get('id'))] = session.get('sensor_id', session.get('device_id'))
+
+        return sessions
+
+    def get_live_tuids(self):
+        '''
+        Gets the TUIDs of the sweeps that are still active.
+
+        :return tuids:
+        '''
+
+        return set(str(task['tuid']) for task in CB_BOT_DB.task_history.find({'task': 'sweep', 'active': True}))
+
+    def get_orphans(self, sessions):
+        '''
+        Matches the open sessions against the live TUIDs and the
+        claims in the lr_sessions collection.
+
+        :param sessions:
+        :return orphans: list of (session_id, device_id).
+        '''
+        live_tuids = self.get_live_tuids()
+        now = datetime.datetime.utcnow()
+        stale = now - datetime.timedelta(seconds=self.lease_timeout)
+        expired = now - datetime.timedelta(seconds=self.idle_window)
+
+        tracked = {str(doc['session_id']): doc for doc in CB_BOT_DB.lr_sessions.find({})}
+        orphans = list()
+
+        for session_id, device_id in sessions.items():
+            doc = tracked.get(session_id)
+
+            # Not opened by cb-bot.
+            if doc == None:
+                continue
+
+            claims = doc.get('claims', {})
+            owned = [tuid for tuid, heartbeat in claims.items() if tuid in live_tuids and heartbeat > stale]
+
+            # Nobody closes the idle sessions of a task that was
+            # killed, so they only count as warm while it is live.
+            warm = doc.get('idle_since') and doc['idle_since'] > expired and doc.get('released_by') in live_tuids
+
+            if not (owned or warm):
+                orphans.append((session_id, device_id))
+
+        return orphans
+
+    def close_session(self, session_id):
+        '''
+        Closes one CB session.
+
+        :param session_id:
+        :return closed:
+        '''
+        request_url = '/integrationServices/v3/cblr/session'
+
+        payload = "{\"session_id\": \"%s\",\"status\": \"CLOSE\"}" % session_id
+        header = {'Content-Type': "application/json"}
+
+        try:
+            response = self.client.put('session', request_url,
+                                       content=payload,
+                                       headers=header)
+
+        except Exception as e:
+            print(e)
+            return False
+
+        if response.status_code == 200:
+            return True
+
+        print("[!] Could not close session {}: {}".format(session_id, response.status_code))
+        return False
+
+    def reap(self, _id):
+        '''
+        Closes every orphaned session, as many at a time as
+        the session limit, and drops them from lr_sessions.
+
+        :param _id:
+        :return report: dictionary with the counts.
+        '''
+        sessions = self.get_open_sessions()
+
+        if sessions == None:
+            return None
+
+        orphans = self.get_orphans(sessions)
+        update_task('total_hosts', len(orphans), _id)
+
+        closed = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.max_sessions)) as executor:
+            results = executor.map(lambda orphan: (orphan, self.close_session(orphan[0])), orphans)
+
+            for (session_id, device_id), success in results:
+                if success:
+                    closed += 1
+                    CB_BOT_DB.lr_sessions.delete_one({'session_id': session_id})
+
+                    # session_id is stored as an int or a str,
+                    # depending on what CB returned.
+                    if session_id.isdigit():
+                        CB_BOT_DB.lr_sessions.delete_one({'session_id': int(session_id)})
+
+                update_task('completed_hosts', closed, _id)
+
+        return {'open': len(sessions),
+                'orphaned': len(orphans),
+                'closed': closed,
+                'in_use': len(sessions) - closed}
+
+def get_server_settings():
+    '''
+    Gets the CB Server Configuration from the MongoDB database.
+    '''
+
+    # Get configuration from the MongoDB. There should only be
+    # one item or none.
+    list_data = list(CB_BOT_DB.server_settings.find({"name" : "Carbon Black"}))
+
+    # Determines if there is data to be sent back. If there
+    # are no configurations set, then it should return blank.
+    if len(list_data) > 0:
+        return list_data[0]
+
+    else:
+        return ""
+
+def update_task(data_type, data_value, _id):
+    '''
+    Updated a field for a task in the task_history collection.
+
+    :param data_type:
+    :param data_value:
+    :param _id:
+    '''
+
+    # Updates the record for the task.
+    CB_BOT_DB.task_history.update_one({'_id': _id},
+                                    {'$set': {data_type: data_value}},
+                                    upsert=False)
+
+def get_task(tuid):
+    '''
+    Gets the task information for one task from
+    the MongoDB database.
+    '''
+    # Queries Mongo for the task.
+    return CB_BOT_DB.task_history.find_one({'tuid': int(tuid)})
+
+def create_alert(alert):
+    '''
+    Adds an alert to the MongoDB database 'alerts'
+    collection
+
+    :param alert:
+    '''
+
+    # Adds the log entry to the alerts collection.
+    CB_BOT_DB.alerts.insert_one(alert)
+
+def get_largest_auid():
+    '''
+    Gets the largest AUID for the alerts in the database.
+
+    :return auid:
+    '''
+
+    # Queries the MongoDB database for the largest AUID
+    alert_list = list(CB_BOT_DB.alerts.find({}).sort('auid', pymongo.DESCENDING).limit(1))
+
+    # Checks if there are no AUIDs.
+    if len(alert_list) == 0:
+        return 0
+
+    return alert_list[0]['auid']
+
+def main():
+    '''
+    Main function for the session reaper.
+    '''
+    # Gets the CB settings from the database.
+    config = get_server_settings()
+
+    # Validate if config is empty or not before continuing
+    # as it requires the DB configs to reach CB.
+    if config == '':
+        quit()
+
+    CB_ROOT_URL = config['root_url']
+    CB_XAUTH_TOKEN = '{}/{}'.format(config['api_secret_key'], config['api_id'])
+    CB_CONCURRENT_SESSIONS = int(config['max_sessions'])
+    CB_HTTP2 = str(config.get('http2', 'false')).lower() == 'true'
+    SESSION_LEASE_TIMEOUT = int(config.get('session_lease_timeout', 120))
+    SESSION_IDLE_WINDOW = int(config.get('session_idle_window', 60))
+
+    # Get the task, given the TUID.
+    tuid = sys.argv[1]
+    task = get_task(tuid)
+
+    with cb_client.CB_CLIENT(CB_ROOT_URL, CB_XAUTH_TOKEN, CB_CONCURRENT_SESSIONS, http2=CB_HTTP2) as client:
+        reaper = SESSION_REAPER(client, SESSION_LEASE_TIMEOUT, SESSION_IDLE_WINDOW, CB_CONCURRENT_SESSIONS)
+        report = reaper.reap(task['_id'])
+
+    if report == None:
+        message = "Failed Task ID {}: Reap Orphaned Sessions. Could not list the CB sessions.".format(tuid)
+
+    else:
+        message = ("Completed Task ID {}: Reap Orphaned Sessions. Closed {} of {} orphaned sessions, "
+                   "{} of {} sessions are in use.").format(tuid, report['closed'], report['orphaned'],
+                                                          report['in_use'], CB_CONCURRENT_SESSIONS)
+
+        update_task('reclaimed_sessions', report['closed'], task['_id'])
+
+    print("[*] {}".format(message))
+
+    # Reports how much capacity was reclaimed.
+    timestamp = datetime.datetime.utcnow()
+
+    alert = dict()
+    alert['active'] = True
+    alert['owner'] = task['owner']
+    alert['auid'] = get_largest_auid() + 1
+    alert['message'] = message
+    alert['message_date'] = timestamp.strftime("%B %d, %Y  %-I:%M %p UTC")
+    alert['created'] = timestamp
+
+    create_alert(alert)
+
+    # Change Task status to inactive and terminate the program.
+    update_task('active', False, task['_id'])
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,26 @@
+import asyncio
+import collections
 import datetime
+import gzip
+import hashlib
+import heapq
 import json
+import mmap
 import os
-import queue
+import random
+import shlex
+import shutil
+import subprocess
 import sys
-import threading
-import time
+import uuid
+import zipfile
 
+import httpx
 import pymongo
-import requests
 
-requests.packages.urllib3.disable_warnings()
+import cb_client
+import polling
+import search
 
 # Database configuration
 MONGO_CLIENT = pymongo.MongoClient('127.0.0.1', 5051)
@@ -39,11 +50,20 @@ CB_API_ID = config['api_id']
 CB_XAUTH_TOKEN = '{}/{}'.format(CB_API_SECRET_KEY, CB_API_ID)
 CB_CONCURRENT_SESSIONS = int(config['max_sessions'])
 CB_MIN_CHECK_IN_TIME = int(config['min_check_in_time'])
+CB_HTTP2 = str(config.get('http2', 'false')).lower() == 'true'
 
 # This gets the task id and the command id.
 TUID = int(sys.argv[2])
 CUID = int(CB_BOT_DB.task_history.find_one({'tuid': int(TUID)})['cuid'])
 
+# Standing sweeps park offline hosts until they check in again
+# instead of retrying them, and keep going until the task expires.
+STANDING = bool(CB_BOT_DB.task_history.find_one({'tuid': int(TUID)}).get('standing', False))
+
+# Hash sweeps only download the file from hosts where one of
+# its hashes matches one of these.
+TARGET_HASHES = [h.upper() for h in CB_BOT_DB.task_history.find_one({'tuid': int(TUID)}).get('target_hashes', [])]
+
 # Input value is optional. If set to false, then
 # there is no input file.
 try:
@@ -65,27 +85,128 @@ ERROR_COUNT = 0
 ERROR_THRESHOLD = 100
 
 # This is the API waiting period in seconds and the
-# sleep period between calls.
+# sleep period between calls. The sleep period is only
+# used by the 'fixed' polling strategy, 'backoff' starts
+# fast and backs off up to a ceiling for each phase.
 WAITING_PERIOD = 200
 SLEEP_INTERVAL = 5
+POLLING_STRATEGY = str(config.get('polling_strategy', 'backoff')).lower()
+
+# Most status checks per second that the sweep sends to CB,
+# shared between every session, command and file transfer
+# that is waiting on CB.
+POLLER_RATE_LIMIT = int(config.get('poller_rate_limit', 20))
+
+# Number of hosts taken off the queue and checked ahead of the
+# session budget, so that their session is opened as soon as
+# another host lets go of its session.
+SESSION_PREFETCH = int(config.get('session_prefetch', 5))
+
+# Seconds between two refreshes of the fleet-wide device status
+# snapshot used to check the hosts' last reported time.
+DEVICE_SNAPSHOT_INTERVAL = int(config.get('device_snapshot_interval', 300))
+
+# Size in bytes of the chunks that collected files are streamed
+# and hashed in, and the number of times a broken download is
+# resumed before the file is given up on.
+DOWNLOAD_CHUNK_SIZE = int(config.get('download_chunk_size', 1048576))
+DOWNLOAD_RETRIES = int(config.get('download_retries', 3))
+
+# Windows result codes CB returns when the path of a command
+# does not exist: ERROR_FILE_NOT_FOUND and ERROR_PATH_NOT_FOUND.
+FILE_NOT_FOUND_CODES = (0x80070002, 0x80070003)
+
+# File acquisition sweeps can take several paths separated by
+# ';', with wildcards in them. The matching files are fetched
+# this many at a time in the session of the host.
+FILE_FETCH_CONCURRENCY = int(config.get('file_fetch_concurrency', 4))
+
+# Files of acquisition sweeps larger than the threshold in bytes
+# are fetched in chunks, several at a time, using the offset of
+# the get file command. Finished chunks are checkpointed in the
+# file_chunks collection, so a failed or restarted sweep only
+# fetches the chunks that are missing. A threshold of 0 turns
+# chunking off.
+LARGE_FILE_THRESHOLD = int(config.get('large_file_threshold', 104857600))
+FILE_CHUNK_SIZE = int(config.get('file_chunk_size', 33554432))
+CHUNK_CONCURRENCY = int(config.get('chunk_concurrency', 4))
+
+# With the tool cache, type 2 sweeps leave the uploaded file on
+# the host and skip the upload next time if the same file is
+# still staged there.
+TOOL_CACHE = str(config.get('tool_cache', 'false')).lower() == 'true'
+
+# Search sweeps run their query against the CB search API in
+# pages of this many results, up to the maximum number of
+# results, over the search window. Only the first hits of each
+# host are kept in the sweep log, next to the total count.
+SEARCH_PAGE_SIZE = int(config.get('search_page_size', 1000))
+SEARCH_MAX_RESULTS = int(config.get('search_max_results', 10000))
+SEARCH_WINDOW = str(config.get('search_window', '2w'))
+SEARCH_HITS_PER_HOST = int(config.get('search_hits_per_host', 100))
+
+# Sweeps running at the same time share the CB session of a
+# device. A sweep that has not refreshed its claim on a shared
+# session for this many seconds is considered gone.
+SESSION_LEASE_TIMEOUT = int(config.get('session_lease_timeout', 120))
+
+# Seconds that a session nobody uses anymore is kept open, in
+# case a host is retried or another sweep needs the device. Idle
+# sessions are closed, least recently used first, as soon as the
+# session budget is needed for other hosts.
+SESSION_IDLE_WINDOW = int(config.get('session_idle_window', 60))
+
+# Number of times a host is tried before the sweep gives up on
+# it, and the delay in seconds before the next attempt for each
+# kind of failure. The delay doubles with every attempt, up to
+# the ceiling.
+MAX_ATTEMPTS = int(config.get('max_attempts', 10))
+RETRY_BACKOFF = {
+    'offline': {'delay': 300, 'ceiling': 3600},
+    'session': {'delay': 60, 'ceiling': 1800},
+    'command': {'delay': 30, 'ceiling': 900},
+    'error': {'delay': 60, 'ceiling': 1800},
+}
 
 
 class CB_BOT():
 
-    def __init__(self, queue_list, total_hosts, command_specs, _id, sweep_name):
+    def __init__(self, client, poller, snapshot, queue_list, total_hosts, command_specs, _id, sweep_name):
+        self.client = client
+        self.poller = poller
+        self.snapshot = snapshot
         self.queue_list = queue_list
         self.total_hosts = total_hosts
         self.task_object_id = _id
         self.sweep_name = sweep_name
         self.command_type = command_specs['command_type']
+        self.device_type = command_specs.get('device_type', 'WINDOWS')
+
+        # Sweeps can compress the output on the endpoint before it
+        # is collected, and keep it compressed once collected.
+        self.compress = command_specs.get('compress', False)
+        self.store_compressed = command_specs.get('store_compressed', False)
+
+        # Queues between the stages of the pipeline. The budget
+        # of open sessions is shared between every stage.
+        self.execute_queue = asyncio.Queue()
+        self.collect_queue = asyncio.Queue()
+        self.cleanup_queue = asyncio.Queue()
+        self.session_slots = asyncio.Semaphore(CB_CONCURRENT_SESSIONS)
+        self.errored = asyncio.Event()
+
+        # Sessions are shared with the other sweeps that run on
+        # the same devices at the same time.
+        self.registry = SESSION_REGISTRY(TUID, SESSION_LEASE_TIMEOUT, SESSION_IDLE_WINDOW)
+        self.sessions_in_use = set()
+        self.sessions_closing = 0
+        self.stopping = False
 
         self.ERROR_COUNT = ERROR_COUNT
         self.ERROR_THRESHOLD = ERROR_THRESHOLD
         self.WAITING_PERIOD = WAITING_PERIOD
         self.SLEEP_INTERVAL = SLEEP_INTERVAL
 
-        self.CB_ROOT_URL = CB_ROOT_URL
-        self.CB_XAUTH_TOKEN = CB_XAUTH_TOKEN
         self.CB_CONCURRENT_SESSIONS = CB_CONCURRENT_SESSIONS
         self.CB_MIN_CHECK_IN_TIME = CB_MIN_CHECK_IN_TIME
 
@@ -96,341 +217,740 @@ class CB_BOT():
         if self.command_type == 3:
             self.out_file = INPUT_FILE
             self.command = command_specs['command']
+
+            # Several paths, or paths with wildcards, are expanded
+            # on the endpoint and collected into a folder per host.
+            self.file_patterns = [path.strip() for path in INPUT_FILE.split(';') if path.strip()]
+            self.multi_file = len(self.file_patterns) > 1 or any(('*' in path or '?' in path) for path in self.file_patterns)
+
+            CB_BOT_DB.file_chunks.create_index([('tuid', pymongo.ASCENDING), ('hostname', pymongo.ASCENDING), ('path', pymongo.ASCENDING)])
             # We have to ensure if we need to insert another command or not.
             # self.command = self.command.replace('{||}', out_file)
             
+        # Hash sweeps hash the file on the endpoint and only
+        # collect the small file with the results.
+        elif self.command_type == 4:
+            self.hash_file = INPUT_FILE
+            self.out_file = 'C:\\Windows\\Temp\\cb_bot_hash_{}.txt'.format(self.TUID)
+            self.command = get_hash_command(self.hash_file, self.out_file)
+
+        # Directory listing sweeps only read from the endpoint.
+        elif self.command_type == 5:
+            self.list_path = INPUT_FILE
+            self.command = ''
+
+            CB_BOT_DB.directory_listings.create_index([('tuid', pymongo.ASCENDING), ('device_id', pymongo.ASCENDING)])
+
+        # Process list sweeps store what is running on the hosts,
+        # indexed to find the hosts running a process quickly.
+        elif self.command_type == 6:
+            self.command = ''
+
+            CB_BOT_DB.process_lists.create_index([('tuid', pymongo.ASCENDING), ('device_id', pymongo.ASCENDING)])
+            CB_BOT_DB.process_lists.create_index([('process_name', pymongo.ASCENDING), ('tuid', pymongo.ASCENDING)])
+            CB_BOT_DB.process_lists.create_index([('path', pymongo.ASCENDING)])
+
+        # Registry sweeps read keys and values straight from the
+        # registry, one per line of the command. A line ending
+        # with '::<value name>' reads that value of the key.
+        elif self.command_type == 7:
+            self.command = command_specs['command']
+            self.registry_paths = [line.strip() for line in self.command.splitlines() if line.strip()]
+
+            CB_BOT_DB.registry_values.create_index([('tuid', pymongo.ASCENDING), ('device_id', pymongo.ASCENDING)])
+            CB_BOT_DB.registry_values.create_index([('key', pymongo.ASCENDING), ('tuid', pymongo.ASCENDING)])
+
+        # Pipeline sweeps run a list of steps in the same session.
+        # The files of the 'put' steps are read once for the whole
+        # sweep, like the file of an upload sweep.
+        elif self.command_type == 9:
+            self.command = ''
+            self.steps = command_specs['steps']
+            self.step_payloads = dict()
+
+            for index, step in enumerate(self.steps):
+                if step['action'] == 'put':
+                    self.step_payloads[index] = UPLOAD_PAYLOAD(step['file'])
+
+            CB_BOT_DB.directory_listings.create_index([('tuid', pymongo.ASCENDING), ('device_id', pymongo.ASCENDING)])
+
         # This is another validator looking for the file to
         # upload to CB.
         elif self.command_type == 2:
             self.upload_file = INPUT_FILE
             self.command = COMMAND_TO_EXECUTE
 
+            # The file is read and hashed once for the whole sweep.
+            self.payload = UPLOAD_PAYLOAD(self.upload_file)
+            self.remote_upload_file = 'C:\\Windows\\Temp\\{}'.format(self.payload.name)
+
         else:
             self.command = command_specs['command']
             self.out_file = command_specs['output_file']
 
-    def run_sweep(self):
+    async def run_sweep(self):
         '''
-        Gets a worker to run the designated sweep. The function
-        essentially does the following:
+        Runs the designated sweep as a pipeline. Each host goes
+        through the following stages, and every stage has its
+        own workers so that the next hosts can negotiate their
+        CB session while the current ones are still executing:
 
-            - Open CB Session.
+            - Session: Open CB Session.
                 + Check CB Session is Active.
-            - Run Command using CB Session.
+            - Execute: Run Command using CB Session.
                 + Check Command using CB Session to see if Completed.
-            - Get Created File using CB Session.
-            - Delete Created File using CB Session.
-            - End CB Session.
-
-        '''
-
-        # Ensures that there are no more elements in the Queue to be taking
-        while queue.Queue.qsize(self.queue_list) != 0:
-            # This checks if the error count has met the threshold
-            # in order to prevent from continuous crap out.
-            if self.ERROR_COUNT > self.ERROR_THRESHOLD:
-                # Updates the task ID to false. Indicating that there
-                # was an issue and needs to end.
-
-                # Checks if there are more threads running before
-                # setting this to false.
-                # ========= DEV =========
-                print("Active threads: {}".format(threading.active_count()))
-                # ========= DEV =========
-
-                if threading.active_count() == 1:
-                    # Create an alert.
-                    alert = dict()
-                    auid = get_largest_auid() + 1
-                    timestamp = datetime.datetime.utcnow()
-                    alert['created'] = timestamp
-                    alert['message_date'] = timestamp.strftime("%B %d, %Y  %-I:%M %p UTC")
-                    alert['active'] = True
-                    alert['owner'] = get_task_owner()
-                    alert['auid'] = auid
-                    alert['message'] = "Failed Sweep with Task ID {}: {}. cb_bot workers errored out.".format(self.TUID, self.sweep_name)
-
-                    # Tell Mongo to add alert.
-                    create_alert(alert)
-
-                    # Updated the task.
-                    update_task('active', False, self.task_object_id)
-
-                # Kills the thread and ultimately the sweep.
-                quit()
+            - Collect: Get Created File using CB Session.
+            - Cleanup: Delete Created File using CB Session.
+                + End CB Session.
+
+        Open sessions are bound by self.session_slots, which is
+        the CB session budget. SESSION_PREFETCH more session
+        workers than sessions look ahead in the queue, so the
+        next hosts are checked and waiting for a slot, which a
+        host hands over as soon as it lets go of its session
+        in the cleanup stage.
+
+        :return success:
+        '''
+        stages = [(self.session_stage, self.CB_CONCURRENT_SESSIONS + SESSION_PREFETCH),
+                  (self.execute_stage, self.CB_CONCURRENT_SESSIONS),
+                  (self.collect_stage, self.CB_CONCURRENT_SESSIONS),
+                  (self.cleanup_stage, self.CB_CONCURRENT_SESSIONS)]
 
-            try:
-                # Collects an available queue object
-                queue_obj = self.queue_list.get(timeout=1)
-                
-                # Define the sensor name and the id based
-                # on the queue object obtained.
-                sensor_name = queue_obj.split('||')[0]
-                sensor_id = queue_obj.split('||')[1]
+        workers_list = [asyncio.ensure_future(stage()) for stage, count in stages for i in range(count)]
+        workers_list.append(asyncio.ensure_future(self.registry.run()))
+        workers_list.append(asyncio.ensure_future(self.reap_stage()))
+
+        # The sweep is done once every host has made it through
+        # the pipeline without being re-queued, or once the workers
+        # have errored out too many times.
+        done = asyncio.ensure_future(self.queue_list.join())
+        errored = asyncio.ensure_future(self.errored.wait())
+
+        # Standing sweeps also stop once the task expires.
+        expiration = get_task_object_id().get('expiration')
+
+        if STANDING and expiration:
+            seconds = (expiration - datetime.datetime.utcnow()).total_seconds()
+            expired = asyncio.ensure_future(asyncio.sleep(max(0, seconds)))
+
+        else:
+            expired = asyncio.ensure_future(asyncio.Event().wait())
+
+        await asyncio.wait([done, errored, expired], return_when=asyncio.FIRST_COMPLETED)
+
+        # Lets the hosts that have a session finish and close it
+        # before stopping, then records which hosts never made it.
+        if expired.done() and not done.done():
+            await self.stop_sweep()
+
+        for worker in workers_list + [done, errored, expired]:
+            worker.cancel()
+
+        # Closes the sessions that were kept warm.
+        for device_id, session_id in self.registry.reap(len(self.registry.idle)):
+            await self.session_close(session_id, device_id)
+
+        if self.command_type == 2:
+            self.payload.close()
+
+        elif self.command_type == 9:
+            for payload in self.step_payloads.values():
+                payload.close()
+
+        return not self.errored.is_set()
+
+    async def stop_sweep(self):
+        '''
+        Stops taking new hosts, waits for the hosts that hold a
+        CB session to be cleaned up, and marks every host left in
+        the queue as expired.
+        '''
+        self.stopping = True
+
+        # Once the whole session budget can be taken, no host
+        # is holding a session anymore.
+        try:
+            for i in range(self.CB_CONCURRENT_SESSIONS):
+                await asyncio.wait_for(self.session_slots.acquire(), self.WAITING_PERIOD)
+
+        except asyncio.TimeoutError:
+            print("[TASK ID: {}] Timed out waiting for sessions to close.".format(self.TUID))
+
+        for item in self.queue_list.get_items():
+            host_object_id = self.get_sweep_log_host_id(item.split('||')[1])
+            self.update_one_host_sweep('status', 'Task expired before the host could be swept.', host_object_id)
+
+    async def session_stage(self):
+        '''
+        Takes hosts off the queue, checks that they reported in
+        recently enough and opens a CB session on them.
+        '''
+        while True:
+            # Collects an available queue object.
+            queue_obj = await self.queue_list.get()
+
+            # The sweep is stopping, leave the host in the queue.
+            if self.stopping:
+                self.queue_list.put_back(queue_obj)
+                return
+
+            # Define the sensor name and the id based
+            # on the queue object obtained.
+            host = dict()
+            host['sensor_name'] = queue_obj.split('||')[0]
+            host['sensor_id'] = queue_obj.split('||')[1]
+            host['session_id'] = -1
 
+            try:
                 # Host Mongo DB object ID
-                host_object_id = self.get_sweep_log_host_id(sensor_id)
+                host['host_object_id'] = self.get_sweep_log_host_id(host['sensor_id'])
 
                 # We need to check the time of the sensor's last
                 # reported timestamp. If falls within the scope,
-                # work on it.
-                host_last_reported = self.get_host_last_reported_time(sensor_id)
+                # work on it. This is a lookup in the device snapshot,
+                # so offline hosts do not cost any API call.
+                host_last_reported = await self.get_host_last_reported_time(host['sensor_id'])
+                host['last_reported'] = host_last_reported
 
                 # Check if no timestamp was recorded
-                if host_last_reported != False:
-                    # Continue since there is a host_last_reported
-                    time_elapsed = datetime.datetime.utcnow() - host_last_reported
-                    duration = time_elapsed.total_seconds()
-                    total_diff = int(divmod(duration, 3600)[0])
-
-                    # Validate if time is greater than the self.CB_MIN_CHECK_IN_TIME
-                    # before proceeding. if it is greater, just break and re-add
-                    # the host back to the list.
-                    if total_diff <= self.CB_MIN_CHECK_IN_TIME:
-
-                        # # ========= DEV =========
-                        # print("Active threads: {}".format(threading.active_count()))
-                        # print("Queue size: {}".format(queue.Queue.qsize(self.queue_list)))
-                        # print("Working on host: {} | {}".format(sensor_name, sensor_id))
-                        # # ========= DEV =========
-
-                        print("[TASK ID: {}] Active threads: {}".format(self.TUID, threading.active_count()))
-                        print("[TASK ID: {}] Queue Size: {}".format(self.TUID, queue.Queue.qsize(self.queue_list)))
-
-                        ###########################
-                        # Step 1: Open CB Session #
-                        ###########################
-
-                        # Attempts to get a LR session.
-                        session_id = self.session_open(sensor_id, sensor_name)
-
-                        # Check if response was valid. -1 indicates that
-                        # nothing was sent back. Adds the sensor_id to the list
-                        # of unfinished ones.
-                        if session_id != -1:
-                            ############################################
-                            # Step 2: Check Command Type And Run Sweep #
-                            ############################################
-
-                            # Depending on the type of sweep, we need to
-                            # perform different sets of actions. So here,
-                            # we check for the command type, and follow
-                            # the set of actions we need per job.
-                            
-                            # ==== Type 1: Run command and get file output. ====
-                            if self.command_type == 1:
-                                # Execute the command that we want it to do.
-                                command_status = self.command_execute(session_id, sensor_name)
-
-                                if command_status == True:
-                                    # Goes to collect the file.
-                                    file_results = self.get_file_request(session_id, sensor_name)
-
-                                    # This is if the file collection was complete.
-                                    if file_results == True:
-                                        # Update the host in the sweep log.
-                                        self.update_one_host_sweep('status', 'Results collected!', host_object_id)
-                                        self.update_one_host_sweep('complete', True, host_object_id)
-                                        self.update_one_host_sweep('completed_timestamp', datetime.datetime.utcnow(), host_object_id)
-
-                                    else:
-                                        # We were not able to get a file, there was an error.
-                                        self.update_one_host_sweep('status', 'Command ran, but was unable to collect results.', host_object_id)
-                                        self.queue_list.put('{}||{}'.format(sensor_name, sensor_id))
-
-                                    # Delete file on disk.
-                                    results = self.delete_file(session_id, sensor_name, self.out_file)
-
-                                    # Store updated list in Mongo.
-                                    self.update_completed_hosts_task()
-
-                                else:
-                                    # We were not able to run a command.
-                                    self.update_one_host_sweep('status', 'Could not run command on the host.', host_object_id)
-                                    self.queue_list.put('{}||{}'.format(sensor_name, sensor_id))
-
-
-                            # ==== Type 2: Upload file and run. ====
-                            elif self.command_type == 2:
-                                
-                                # Send request to upload file.
-                                upload_status = self.upload_file_to_cb(session_id, sensor_name)
-
-                                # If upload worked, execute it.
-                                if upload_status == True:
-                                    # Execute the command that we want it to do.
-                                    command_status = self.command_execute(session_id, sensor_name)
-
-                                    if command_status == True:
-                                        # We were not able to get a file, there was an error.
-                                        self.update_one_host_sweep('status', 'Success. File uploaded and command executed.', host_object_id)
-                                        self.update_one_host_sweep('complete', True, host_object_id)
-                                        self.update_one_host_sweep('completed_timestamp', datetime.datetime.utcnow(), host_object_id)
-
-                                        # Delete file on disk.
-                                        results = self.delete_file(session_id, sensor_name, self.upload_file)
-
-                                        # Store updated list in Mongo.
-                                        self.update_completed_hosts_task()
-
-                                    else:
-                                        # We were not able to run a command.
-                                        self.update_one_host_sweep('status', 'Could not run command on the host.', host_object_id)
-                                        self.queue_list.put('{}||{}'.format(sensor_name, sensor_id))
-
-                                # Re-add to queue and update host status.
-                                else:
-                                    # We were not able to upload file.
-                                    self.update_one_host_sweep('status', 'Error uploading file to the system.', host_object_id)
-                                    self.queue_list.put('{}||{}'.format(sensor_name, sensor_id))
-
-                            # ==== Type 3: Get file from system. ====
-                            elif self.command_type == 3:
-                                
-                                # Goes to collect the file.
-                                file_results = self.get_file_request(session_id, sensor_name)
-
-                                # This is if the file collection was complete.
-                                if file_results == True:
-                                    # Update the host in the sweep log.
-                                    self.update_one_host_sweep('status', 'Results collected!', host_object_id)
-                                    self.update_one_host_sweep('complete', True, host_object_id)
-                                    self.update_one_host_sweep('completed_timestamp', datetime.datetime.utcnow(), host_object_id)
-
-                                else:
-                                    # We were not able to get a file, there was an error.
-                                    self.update_one_host_sweep('status', 'Unable to collect file!', host_object_id)
-                                    self.queue_list.put('{}||{}'.format(sensor_name, sensor_id))
-
-                                # Delete file on disk.
-                                results = self.delete_file(session_id, sensor_name, self.out_file)
-
-                                # Store updated list in Mongo.
-                                self.update_completed_hosts_task()
+                if host_last_reported == False:
+                    self.requeue_host(host, 'offline', 'No last reported timestamp recorded.')
+                    continue
 
-                            else:
-                                print("COMMAND DOES NOT EXIST! NEED TO ADD ACTION.")
+                # Validate if time is greater than the self.CB_MIN_CHECK_IN_TIME
+                # before proceeding. if it is greater, just re-add the host
+                # back to the list.
+                time_elapsed = datetime.datetime.utcnow() - host_last_reported
+                duration = time_elapsed.total_seconds()
+                total_diff = int(divmod(duration, 3600)[0])
+
+                if total_diff > self.CB_MIN_CHECK_IN_TIME:
+                    self.requeue_host(host, 'offline', 'Host falls outside of minimum check in time.')
+                    continue
+
+                # Waits for room in the CB session budget.
+                await self.session_slots.acquire()
+                host['session_slot'] = True
+
+                # The sweep is stopping, leave the host in the queue.
+                if self.stopping:
+                    self.session_slots.release()
+                    self.queue_list.put_back(queue_obj)
+                    return
+
+                print("[TASK ID: {}] Queue Size: {}".format(self.TUID, self.queue_list.qsize()))
+
+                # Attempts to get a LR session.
+                host['session_id'] = await self.session_acquire(host['sensor_id'], host['sensor_name'])
+
+                # Check if response was valid. -1 indicates that
+                # nothing was sent back.
+                if host['session_id'] == -1:
+                    self.requeue_host(host, 'session', 'Could not establish a CB session.')
+                    continue
+
+                await self.execute_queue.put(host)
+
+            except Exception as e:
+                self.error_host(host, e)
+
+    async def execute_stage(self):
+        '''
+        Runs the command on hosts with an active CB session.
+        Depending on the type of sweep, we need to perform
+        different sets of actions.
+        '''
+        while True:
+            host = await self.execute_queue.get()
 
-                            ##################################################
-                            # Step 3: Close Session & Remove Host From Queue #
-                            ##################################################
+            try:
+                # ==== Type 1: Run command and get file output. ====
+                if self.command_type in (1, 4):
+                    # Execute the command that we want it to do.
+                    command_status = await self.command_execute(host['session_id'], host['sensor_name'])
+
+                    if command_status == True:
+                        await self.collect_queue.put(host)
+
+                    else:
+                        # We were not able to run a command.
+                        self.update_one_host_sweep('status', 'Could not run command on the host.', host['host_object_id'])
+                        await self.cleanup_queue.put(host)
+
+                # ==== Type 2: Upload file and run. ====
+                elif self.command_type == 2:
+                    # Skips the upload if the same file is still
+                    # staged on the host from an earlier sweep.
+                    if TOOL_CACHE and await self.check_staged_payload(host):
+                        host['staged'] = True
+                        upload_status = True
+
+                    # CB cannot upload over an existing file, so the
+                    # file left staged by an earlier sweep goes first.
+                    elif await self.unstage_payload(host) == False:
+                        upload_status = False
+
+                    else:
+                        # Send request to upload file.
+                        upload_status = await self.upload_file_to_cb(host['session_id'], host['sensor_name'])
+
+                        # Remembers what was staged on the host.
+                        if upload_status == True and TOOL_CACHE:
+                            await self.record_staged_payload(host)
+
+                    # If upload worked, execute it.
+                    if upload_status == True:
+                        # Execute the command that we want it to do.
+                        command_status = await self.command_execute(host['session_id'], host['sensor_name'])
 
-                            # Close session without caring what command type it is
-                            # or if the commands successfully ran or not.
-                            self.session_close(session_id, sensor_name)
+                        if command_status == True:
+                            self.update_one_host_sweep('sha256', self.payload.sha256, host['host_object_id'])
+
+                            if host.get('staged'):
+                                self.complete_host(host, 'Success. Staged file reused and command executed.')
+
+                            else:
+                                self.complete_host(host, 'Success. File uploaded and command executed.')
+
+                            # Delete the uploaded file, unless it stays
+                            # staged for the next sweep.
+                            if not TOOL_CACHE:
+                                host['delete_files'] = [self.remote_upload_file]
 
                         else:
-                            self.update_one_host_sweep('status', 'Could not establish a CB session.', host_object_id)
-                            self.queue_list.put('{}||{}'.format(sensor_name, sensor_id))
+                            # We were not able to run a command.
+                            self.update_one_host_sweep('status', 'Could not run command on the host.', host['host_object_id'])
 
                     else:
-                        self.update_one_host_sweep('status', 'Host falls outside of minimum check in time.', host_object_id)
-                        self.queue_list.put('{}||{}'.format(sensor_name, sensor_id))
+                        # We were not able to upload file.
+                        self.update_one_host_sweep('status', 'Error uploading file to the system.', host['host_object_id'])
+
+                    await self.cleanup_queue.put(host)
+
+                # ==== Type 5: List a directory. ====
+                elif self.command_type == 5:
+                    await self.collect_listing(host)
+                    await self.cleanup_queue.put(host)
+
+                # ==== Type 6: List the running processes. ====
+                elif self.command_type == 6:
+                    await self.collect_processes(host)
+                    await self.cleanup_queue.put(host)
+
+                # ==== Type 7: Query the registry. ====
+                elif self.command_type == 7:
+                    await self.collect_registry(host)
+                    await self.cleanup_queue.put(host)
+
+                # ==== Type 9: Run the steps of the pipeline. ====
+                elif self.command_type == 9:
+                    await self.run_steps(host)
+                    await self.cleanup_queue.put(host)
+
+                # ==== Type 3: Get files matching the patterns. ====
+                elif self.command_type == 3 and self.multi_file:
+                    await self.collect_files(host)
+                    await self.cleanup_queue.put(host)
+
+                # ==== Type 3: Get file from system. ====
+                elif self.command_type == 3:
+                    # Checks the file is there first, so hosts without
+                    # it do not wait on the get file command to fail.
+                    # The entry is kept to size the collection later.
+                    host['file_entry'] = await self.get_file_entry(host['session_id'], host['sensor_name'], self.out_file)
+
+                    if host['file_entry'] == False:
+                        self.update_one_host_sweep('file_present', False, host['host_object_id'])
+                        self.complete_host(host, 'File not present.')
+                        await self.cleanup_queue.put(host)
+
+                    else:
+                        await self.collect_queue.put(host)
+
+                else:
+                    print("COMMAND DOES NOT EXIST! NEED TO ADD ACTION.")
+                    await self.cleanup_queue.put(host)
+
+            except Exception as e:
+                self.error_host(host, e)
+
+    async def collect_stage(self):
+        '''
+        Downloads the output file from hosts that ran the
+        command, or the requested file for file acquisitions.
+        '''
+        while True:
+            host = await self.collect_queue.get()
+
+            try:
+                # ==== Type 4: Hash the file. ====
+                if self.command_type == 4:
+                    await self.collect_hash(host)
+                    await self.cleanup_queue.put(host)
+                    continue
+
+                file_path = self.out_file
+
+                # Delete file on disk.
+                host['delete_files'] = [self.out_file]
+
+                # Compresses the file on the endpoint first. If that
+                # does not work, the raw file is collected instead.
+                if self.compress:
+                    archive_path = await self.compress_file(host['session_id'], host['sensor_name'], self.out_file)
+
+                    if archive_path != False:
+                        file_path = archive_path
+                        host['delete_files'].append(archive_path)
+
+                # Goes to collect the file. The listing of the file
+                # only applies if it is collected as it is.
+                if file_path == self.out_file:
+                    file_results = await self.get_file_request(host['session_id'], host['sensor_name'], file_path, entry=host.get('file_entry'))
+
+                else:
+                    file_results = await self.get_file_request(host['session_id'], host['sensor_name'], file_path)
+
+                # Extracts the collected archive. This reads and writes
+                # the whole file, so it runs off the event loop.
+                if file_results != False and file_path != self.out_file and not self.store_compressed:
+                    file_results = await asyncio.get_event_loop().run_in_executor(None, self.decompress_file, file_results['path'])
+
+                # This is if the file collection was complete.
+                if file_results != False:
+                    self.update_one_host_sweep('sha256', file_results['sha256'], host['host_object_id'])
+                    self.update_one_host_sweep('file_size', file_results['size'], host['host_object_id'])
+
+                    # Files fetched in chunks record how they were checked.
+                    if 'verified' in file_results:
+                        self.update_one_host_sweep('verified', file_results['verified'], host['host_object_id'])
+                        self.update_one_host_sweep('verification', file_results['verification'], host['host_object_id'])
+
+                    self.complete_host(host, 'Results collected!')
+
+                # We were not able to get a file, there was an error.
+                elif self.command_type == 1:
+                    self.update_one_host_sweep('status', 'Command ran, but was unable to collect results.', host['host_object_id'])
 
                 else:
-                    self.update_one_host_sweep('status', 'No last reported timestamp recorded.', host_object_id)
-                    self.queue_list.put('{}||{}'.format(sensor_name, sensor_id))
+                    self.update_one_host_sweep('status', 'Unable to collect file!', host['host_object_id'])
+
+                await self.cleanup_queue.put(host)
+
+            except Exception as e:
+                self.error_host(host, e)
+
+    async def cleanup_stage(self):
+        '''
+        Deletes files left on the host and closes the CB session
+        whether the commands successfully ran or not. Hosts that
+        did not complete are put back on the queue.
+        '''
+        while True:
+            host = await self.cleanup_queue.get()
+
+            try:
+                # Delete files on disk.
+                for file_to_delete in host.get('delete_files', []):
+                    await self.delete_file(host['session_id'], host['sensor_name'], file_to_delete)
+
+                # Store updated list in Mongo.
+                if host.get('complete'):
+                    self.update_completed_hosts_task()
 
-                # Regardless of the job, this task should be done.
-                # Ideally this should prevent any errors regarding
-                # 'task_done' called too many times.
-                self.queue_list.task_done()
+                # Close session without caring what command type it is
+                # or if the commands successfully ran or not.
+                await self.session_release(host['sensor_id'], host['session_id'], host['sensor_name'])
+
+                # The next host can open its session while this one
+                # is taken out of the pipeline.
+                self.release_slot(host)
 
             except Exception as e:
-                self.ERROR_COUNT += 1
-                self.queue_list.task_done()
-                self.queue_list.put('{}||{}'.format(sensor_name, sensor_id))
+                self.error_host(host, e, close_session=False)
+                continue
+
+            if host.get('complete'):
+                self.release_host(host)
+
+            else:
+                self.requeue_host(host, host.get('failure', 'command'))
+
+    def complete_host(self, host, status):
+        '''
+        Marks a host as complete in the sweep log.
+
+        :param host:
+        :param status:
+        '''
+        host['complete'] = True
+
+        # Update the host in the sweep log.
+        self.update_one_host_sweep('status', status, host['host_object_id'])
+        self.update_one_host_sweep('complete', True, host['host_object_id'])
+        self.update_one_host_sweep('completed_timestamp', datetime.datetime.utcnow(), host['host_object_id'])
+
+    def wake_hosts(self, snapshot):
+        '''
+        Wakes up the parked hosts that checked in, and gives up
+        on the ones that are not in the device snapshot anymore.
+
+        :param snapshot:
+        '''
+
+        for item in self.queue_list.wake(snapshot):
+            host_object_id = self.get_sweep_log_host_id(item.split('||')[1])
+            self.update_one_host_sweep('status', 'Host is not in the CB device list anymore.', host_object_id)
+            self.update_one_host_sweep('gave_up', True, host_object_id)
+            self.queue_list.task_done()
+
+    def release_host(self, host):
+        '''
+        Takes a host out of the pipeline and gives its place
+        in the CB session budget, if it had one, to the next
+        host.
+
+        :param host:
+        '''
+        self.release_slot(host)
+        self.queue_list.task_done()
+
+    def release_slot(self, host):
+        '''
+        Gives the place of a host in the CB session budget, if
+        it had one, to the next host.
+
+        :param host:
+        '''
+        if host.get('session_slot'):
+            self.session_slots.release()
+            host['session_slot'] = False
+
+    def requeue_host(self, host, failure, status=None):
+        '''
+        Schedules a retry for a host that did not complete, then
+        takes it out of the pipeline. The retry is delayed based
+        on the kind of failure. Once the host has used up all of
+        its attempts, it is marked as given up in the sweep log.
+
+        :param host:
+        :param failure:
+        :param status:
+        '''
+        if status:
+            self.update_one_host_sweep('status', status, host['host_object_id'])
+
+        # Standing sweeps park offline hosts, without using up an
+        # attempt, until the device snapshot shows they checked in.
+        if STANDING and failure == 'offline':
+            self.queue_list.park('{}||{}'.format(host['sensor_name'], host['sensor_id']), host.get('last_reported', False))
+            self.update_one_host_sweep('status', 'Waiting for the host to check in.', host['host_object_id'])
+
+            return self.release_host(host)
+
+        item = '{}||{}'.format(host['sensor_name'], host['sensor_id'])
+        attempts = self.queue_list.retry(item, failure)
+
+        if 'host_object_id' in host:
+            if attempts == False:
+                # Records the final attempt before giving up.
+                self.update_one_host_sweep('attempts', self.queue_list.attempts[item], host['host_object_id'])
+                self.update_one_host_sweep('status', 'Gave up after {} attempts.'.format(self.queue_list.max_attempts), host['host_object_id'])
+                self.update_one_host_sweep('gave_up', True, host['host_object_id'])
+
+            else:
+                self.update_one_host_sweep('attempts', attempts, host['host_object_id'])
+
+        self.release_host(host)
+
+    def error_host(self, host, e, close_session=True):
+        '''
+        Counts an error for a host and puts it back on the queue.
+        If the host has an open session, it goes through cleanup
+        first so the session gets closed. This checks if the error
+        count has met the threshold in order to prevent from
+        continuous crap out.
+
+        :param host:
+        :param e:
+        :param close_session:
+        '''
+        self.ERROR_COUNT += 1
+
+        if close_session and host['session_id'] != -1:
+            host['complete'] = False
+            host['failure'] = 'error'
+            self.cleanup_queue.put_nowait(host)
 
-                # ========= DEV =========
-                print("Some error ocurred. Count is at: {}".format(self.ERROR_COUNT))
-                print(e)
-                # ========= DEV =========
+        else:
+            # Drops the claim on the session, so it does not stay
+            # alive for the other sweeps that share it.
+            if host.get('session_id', -1) != -1:
+                self.sessions_in_use.discard(int(host['sensor_id']))
+
+                if self.registry.release(host['sensor_id'], host['session_id'], keep_warm=False) == True:
+                    asyncio.ensure_future(self.session_close(host['session_id'], host['sensor_name']))
+
+            self.requeue_host(host, 'error')
+
+        if self.ERROR_COUNT > self.ERROR_THRESHOLD:
+            self.errored.set()
 
-    def session_check(self, session_id, sensor_name):
+        # ========= DEV =========
+        print("Some error ocurred. Count is at: {}".format(self.ERROR_COUNT))
+        print(e)
+        # ========= DEV =========
+
+    async def session_check(self, session_id, sensor_name):
         '''
         This checks a session. We will try for 5 minutes,
         or whichever self.WAITING_PERIOD is set to in seconds.
         If no session comes up, we will add to unifinished
         hosts and move on with the queue.
         '''
-        count = 0 
+        # Waits for the status poller to see the session go
+        # 'ACTIVE' or to run out of the waiting period.
+        results = await self.poller.watch('session', session_id)
+
+        # Confirms if there is an active LR Session or not.
+        if results == False:
+            return False
+
+        return True
+
+    async def session_close(self, session_id, sensor_name):
+        '''
+        This closes an 'ACTIVE' CB session. Sessions that could
+        not be closed are left for the session reaper.
 
-        # This is to try a request every 2 seconds.
-        while count < self.WAITING_PERIOD:
-            # Sleep for self.SLEEP_INTERVAL in seconds
-            time.sleep(self.SLEEP_INTERVAL)
+        :param session_id:
+        :param sensor_name:
+        :return closed:
+        '''
 
-            # Variables used for the GET request.
-            request_url = '{}/integrationServices/v3/cblr/session/{}'.format(self.CB_ROOT_URL, session_id)
-            header = {'X-Auth-Token': self.CB_XAUTH_TOKEN}
+        request_url = '/integrationServices/v3/cblr/session'
 
-            # Sends GET request to check on a CB Session
-            response = requests.get(request_url,
-                                    headers=header,
-                                    verify=False,
-                                    timeout=180)
+        payload = "{\"session_id\": \"%s\",\"status\": \"CLOSE\"}" % session_id
+        header = {'Content-Type': "application/json"}
 
-            # Check if it was a valid response.
-            if response.status_code == 200:
-                # # Debug log
-                # print("[RUNNING] Checking on CB session for {} ({}). Attempt #{}".format(sensor_name, session_id, int((count+2)/2)))
+        # The session still counts against the budget until CB
+        # has closed it.
+        self.sessions_closing += 1
 
-                # This is to check if the session is active.
-                results = json.loads((response.content).decode())
+        try:
+            response = await self.client.put('session', request_url,
+                                             content=payload,
+                                             headers=header)
 
-                # Confirms if there is an active LR Session or not.
-                # If it says PENDING, we should wait for a session
-                # ID to spin up. 
-                if results.get('status') == "ACTIVE":
-                    # print("[DONE] CB Session for {} is 'ACTIVE'!".format(sensor_name))
-                    return True
+        except Exception as e:
+            print("[!] Could not close session {} on {}: {}".format(session_id, sensor_name, e))
+            return False
 
-            # Keep adding to the counter to exit.
-            count += self.SLEEP_INTERVAL
+        finally:
+            self.sessions_closing -= 1
 
-        # Assuming no live session could be established after 2 minutes
+        # Checks if the session successfully closed.
+        if response.status_code == 200:
+            return True
+
+        print("[!] Could not close session {} on {}: {}".format(session_id, sensor_name, response.status_code))
         return False
 
-    def session_close(self, session_id, sensor_name):
+    async def session_acquire(self, sensor_id, sensor_name):
         '''
-        This closes an 'ACTIVE' CB session.
+        Gets a CB session on the host. If another running sweep
+        already has a session on the host, this sweep joins it
+        instead of opening its own, since CB only allows one
+        session per device.
+
+        Sessions kept warm on the host, or left behind by an
+        earlier run of this task, are reused the same way.
+
+        :param sensor_id:
+        :param sensor_name:
+        :return session_id:
         '''
+        session_id = self.registry.join(sensor_id)
 
-        request_url = '{}/integrationServices/v3/cblr/session'.format(self.CB_ROOT_URL)
+        # Makes sure the shared session is still up.
+        if session_id != None:
+            if await self.session_check(session_id, sensor_name) == True:
+                self.sessions_in_use.add(int(sensor_id))
+                return session_id
 
-        payload = "{\"session_id\": \"%s\",\"status\": \"CLOSE\"}" % session_id
-        header = {'X-Auth-Token': self.CB_XAUTH_TOKEN,
-                  'Content-Type': "application/json"}
+            self.registry.release(sensor_id, session_id, keep_warm=False)
+
+        # The session counts against the budget while it is being
+        # opened, so the other workers do not open one in its place.
+        self.sessions_in_use.add(int(sensor_id))
+
+        # Closes idle sessions if the budget is used up.
+        await self.make_room()
+
+        session_id = await self.session_open(sensor_id, sensor_name)
+
+        if session_id != -1:
+            self.registry.claim(sensor_id, session_id)
+
+        else:
+            self.sessions_in_use.discard(int(sensor_id))
+
+        return session_id
+
+    async def session_release(self, sensor_id, session_id, sensor_name):
+        '''
+        Lets go of the CB session on the host. The session is
+        kept warm for SESSION_IDLE_WINDOW seconds if no other
+        running sweep is still using it.
+
+        :param sensor_id:
+        :param session_id:
+        :param sensor_name:
+        '''
+        self.sessions_in_use.discard(int(sensor_id))
+
+        if self.registry.release(sensor_id, session_id) == True:
+            await self.session_close(session_id, sensor_name)
+
+    async def make_room(self):
+        '''
+        Closes idle sessions, least recently used first, until
+        there is room in the session budget for the session that
+        is being opened, which is already in self.sessions_in_use.
+        '''
+        needed = len(self.sessions_in_use) + len(self.registry.idle) + self.sessions_closing - self.CB_CONCURRENT_SESSIONS
+
+        if needed > 0:
+            for device_id, session_id in self.registry.reap(needed):
+                await self.session_close(session_id, device_id)
+
+    async def reap_stage(self):
+        '''
+        Closes the sessions that have been idle for longer than
+        SESSION_IDLE_WINDOW.
+        '''
 
-        response = requests.put(request_url,
-                                data=payload,
-                                headers=header,
-                                verify=False,
-                                timeout=180)
+        while True:
+            await asyncio.sleep(max(1, SESSION_IDLE_WINDOW / 4))
 
-        # FUTURE ADDITION. CHECK IF SESSION SUCCESSFULLY CLOSED.
-        # if response.status_code == 200:
-        #     # Successfully closed
-        #     pass
+            try:
+                for device_id, session_id in self.registry.reap():
+                    await self.session_close(session_id, device_id)
 
-        # else:
-        #     # Do something since it may or may have not closed.
-        #     pass
+            except Exception as e:
+                print("Error closing idle sessions: {}".format(e))
 
-    def session_open(self, sensor_id, sensor_name):
+    async def session_open(self, sensor_id, sensor_name):
         '''
         This opens up a session for CB.
         '''
 
         # Variables used for the POST request.
-        request_url = '{}/integrationServices/v3/cblr/session/{}'.format(self.CB_ROOT_URL, sensor_id)
-        header = {'X-Auth-Token': self.CB_XAUTH_TOKEN}
+        request_url = '/integrationServices/v3/cblr/session/{}'.format(sensor_id)
 
         # Sends POST request to obtain a CB Session ID
-        response = requests.post(request_url,
-                                 headers=header,
-                                 verify=False,
-                                 timeout=180)
+        response = await self.client.post('session', request_url)
 
         # Check if it was a valid response.
         if response.status_code == 200:
@@ -442,7 +962,7 @@ class CB_BOT():
             # If it says PENDING, we should wait for a session
             # ID to spin up. 
             if results.get('status') == "PENDING":
-                session_id_flag = self.session_check(results.get('id'), sensor_name)
+                session_id_flag = await self.session_check(results.get('id'), sensor_name)
 
                 # Check if the system is online and we have an
                 # active session.
@@ -462,31 +982,34 @@ class CB_BOT():
             else:
                 return -1
         
-        # Return all other status codes.
+        # Any other status code means there is no session.
         else:
-            return response.status_code
+            return -1
 
-    def command_execute(self, session_id, sensor_name):
+    async def command_execute(self, session_id, sensor_name, command=None):
         '''
         Executes a command in CB and you should get an ID
         to check the status of it.
+
+        :param session_id:
+        :param sensor_name:
+        :param command: defaults to the command of the sweep.
         '''
+        if command == None:
+            command = self.command
 
         # Variables used for the POST request.
-        request_url = '{}/integrationServices/v3/cblr/session/{}/command'.format(self.CB_ROOT_URL, session_id)
-        header = {'X-Auth-Token': self.CB_XAUTH_TOKEN,
-                  'Content-Type': "application/json"}
+        request_url = '/integrationServices/v3/cblr/session/{}/command'.format(session_id)
+        header = {'Content-Type': "application/json"}
         body = {"session_id": session_id,
                 "name": "create process",
                 "wait": "true",
-                "object": self.command}
+                "object": command}
 
         # Sends POST request to obtain execute a command
-        response = requests.post(request_url,
-                                 headers=header,
-                                 data=json.dumps(body),
-                                 verify=False,
-                                 timeout=180)
+        response = await self.client.post('command', request_url,
+                                          headers=header,
+                                          content=json.dumps(body))
 
         # Makes sure we get a successful response.
         if response.status_code == 200:
@@ -494,366 +1017,2154 @@ class CB_BOT():
             command_id = json.loads((response.content).decode()).get('id')
 
             # Check command and return results.
-            return self.command_check(session_id, sensor_name, command_id)
+            return await self.command_check(session_id, sensor_name, command_id)
 
-    def command_check(self, session_id, sensor_name, command_id):
+    async def queue_command(self, session_id, body):
         '''
-        Checks command status to make sure it finishes
+        Sends a command to a CB session without waiting for it.
+        The sensor runs the commands of a session one after the
+        other, so the next command only starts once this one
+        is done.
+
+        :param session_id:
+        :param body:
+        :return command_id:
         '''
-        # This counter is to make sure that this does not die.
-        # It should never die, but you never know.
-        count = 0 
-
-        # This is to try a request every 2 seconds.
-        while count < self.WAITING_PERIOD:
-            # Sleep for interval in seconds
-            time.sleep(self.SLEEP_INTERVAL)
-
-            # Variables used for the POST request.
-            request_url = '{}/integrationServices/v3/cblr/session/{}/command/{}'.format(self.CB_ROOT_URL, session_id, command_id)
-            header = {'X-Auth-Token': self.CB_XAUTH_TOKEN,
-                      'Content-Type': "application/json"}
-
-            # Sends GET request to obtain command execution status
-            response = requests.get(request_url,
-                                    headers=header,
-                                    verify=False,
-                                    timeout=180)
-
-            # Makes sure we get a successful response
-            if response.status_code == 200:
-                # # Debug log
-                # print("[RUNNING] Checking on CB command for {} ({}). Attempt #{}".format(sensor_name, session_id, int((count+2)/2)))
-
-                # Checks if the command has completed or not.
-                if json.loads((response.content).decode()).get('status') == "complete":
-                    return True
 
-            # Keep adding to the counter to exit.
-            count += self.SLEEP_INTERVAL
+        # Variables used for the POST request.
+        request_url = '/integrationServices/v3/cblr/session/{}/command'.format(session_id)
+        header = {'Content-Type': "application/json"}
+
+        # Sends POST request to queue the command
+        response = await self.client.post('command', request_url,
+                                          headers=header,
+                                          content=json.dumps(body))
+
+        # Makes sure we get a successful response.
+        if response.status_code == 200:
+            return json.loads((response.content).decode()).get('id')
 
-        # Assuming no live session could be established after
-        # the waiting period.
         return False
 
-    def upload_file_to_cb(self, session_id, sensor_name):
+    async def command_check(self, session_id, sensor_name, command_id):
+        '''
+        Checks command status to make sure it finishes
+        '''
+        # Waits for the status poller to see the command finish.
+        results = await self.poller.watch('command', session_id, command_id)
+
+        # Checks if the command has completed or not.
+        if results == False or results.get('status') != "complete":
+            return False
+
+        return True
+
+    async def upload_file_to_cb(self, session_id, sensor_name, payload=None, remote_path=None):
         '''
         Uploads a file to the CB server to then push to
-        the systems reporting in CB.
+        the systems reporting in CB. The file is streamed from
+        the payload shared by every host of the sweep.
+
+        :param session_id:
+        :param sensor_name:
+        :param payload: defaults to the upload file of the sweep.
+        :param remote_path: defaults to the Windows Temp folder.
         '''
+        if payload == None:
+            payload = self.payload
         # Variables used for the POST request.
-        request_url = '{}/integrationServices/v3/cblr/session/{}/file'.format(self.CB_ROOT_URL, session_id)
-
-        header = {'X-Auth-Token': self.CB_XAUTH_TOKEN}
+        request_url = '/integrationServices/v3/cblr/session/{}/file'.format(session_id)
 
-        upload_file = {'file': open(self.upload_file, 'rb')}
+        header = {'Content-Type': payload.get_content_type(),
+                  'Content-Length': str(payload.get_content_length())}
 
-        # Sends POST request to obtain a file
-        response = requests.post(request_url,
-                                 headers=header,
-                                 files=upload_file,
-                                 verify=False,
-                                 timeout=180)
+        # Sends POST request to upload the file
+        response = await self.client.post('file_upload', request_url,
+                                          headers=header,
+                                          content=payload.get_multipart())
 
         # Makes sure we get a successful response.
         if response.status_code == 200:
             # Gets the file id.
             file_id = json.loads((response.content).decode()).get('id')
 
-            # Returns True or False if upload worked well.
-            return self.put_file_request(session_id, sensor_name, file_id)
+            # Returns True or False if upload worked well.
+            return await self.put_file_request(session_id, sensor_name, file_id, remote_path)
+
+        else:
+            return False
+
+    async def put_file_request(self, session_id, sensor_name, file_id, remote_path=None):
+        '''
+        Puts file on the system.
+        '''
+        # The file goes to the Windows Temp folder by default.
+        upload_file = remote_path or self.remote_upload_file
+
+        # Variables used for the POST request.
+        request_url = '/integrationServices/v3/cblr/session/{}/command'.format(session_id)
+
+        header = {'Content-Type': "application/json"}
+
+        body = {"file_id": file_id,
+                "name": "put file",
+                "object": upload_file}
+
+        # Sends POST request to obtain a file
+        response = await self.client.post('command', request_url,
+                                          headers=header,
+                                          content=json.dumps(body))
+
+        # Makes sure we get a successful response.
+        if response.status_code == 200:
+            # Gets the command id.
+            file_upload_id = json.loads((response.content).decode()).get('id')
+
+            # Checks status until done.
+            return await self.put_file_check(session_id, sensor_name, file_upload_id)
+
+        else:
+            return False
+
+    async def put_file_check(self, session_id, sensor_name, file_upload_id):
+        '''
+        Checks status of the file for download
+        '''
+        # Waits for the status poller to see the upload finish.
+        results = await self.poller.watch('put_file', session_id, file_upload_id)
+
+        # Checks if the command has completed or not.
+        if results == False or results.get('status') != "complete":
+            return False
+
+        return True
+
+    async def get_file_request(self, session_id, sensor_name, file_path=None, output_file_path=None, entry=None):
+        '''
+        Grabs a file from CB. It needs to execute a
+        command, and check.
+
+        :param session_id:
+        :param sensor_name:
+        :param file_path: defaults to the output file of the sweep.
+        :param output_file_path: where the file is saved, defaults
+                                 to the output folder of the sweep.
+        :param entry: directory listing entry of the file, if it
+                      was already listed. Large files are fetched
+                      in chunks.
+        :return results:
+        '''
+        if file_path == None:
+            file_path = self.out_file
+
+        # Large files are fetched in chunks.
+        if entry and LARGE_FILE_THRESHOLD > 0 and int(entry.get('size') or 0) > LARGE_FILE_THRESHOLD:
+            return await self.get_file_chunked(session_id, sensor_name, file_path, entry, output_file_path)
+
+        # Variables used for the POST request.
+        request_url = '/integrationServices/v3/cblr/session/{}/command'.format(session_id)
+
+        header = {'Content-Type': "application/json"}
+
+        body = {"session_id": session_id,
+                    "name": "get file",
+                    "object": file_path}
+
+        # Sends POST request to obtain a file
+        response = await self.client.post('command', request_url,
+                                          headers=header,
+                                          content=json.dumps(body))
+
+        # Makes sure we get a successful response.
+        if response.status_code == 200:
+            # Gets the command id.
+            command_id = json.loads((response.content).decode()).get('id')
+
+            # Collects the file_id for download.
+            file_id = await self.get_file_check(session_id, sensor_name, command_id)
+
+            # If no file_id, then return that there was an error.
+            if file_id == False:
+                return False
+
+            # Otherwise, we have file_id, let's download this puppy.
+            return await self.get_file_download(session_id, sensor_name, file_id, file_path, output_file_path)
+
+        else:
+            return False
+
+    async def get_file_check(self, session_id, sensor_name, command_id):
+        '''
+        Checks status of the file for download
+        '''
+        # Waits for the status poller to see the file ready.
+        results = await self.poller.watch('get_file', session_id, command_id)
+
+        # Checks if the command has completed or not.
+        if results == False or results.get('status') != "complete":
+            return False
+
+        return results.get('file_id')
+
+    async def get_file_download(self, session_id, sensor_name, file_id, file_path, output_file_path=None):
+        '''
+        Downloads file to directory. The file is streamed to a
+        partial file and hashed on the way, then renamed into
+        the output folder once it is complete. A download that
+        breaks off is resumed where it stopped, without running
+        the command on the endpoint again.
+
+        :return results:
+        '''
+        if output_file_path == None:
+            output_file_path = self.get_output_file_path(sensor_name, file_path)
+
+        # Checks if directory exists before dumping to folder.
+        output_folder = os.path.dirname(output_file_path)
+
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder, exist_ok=True)
+
+        # The partial file is tied to the file_id, so it is never
+        # resumed with the output of another run of the command.
+        partial_file_path = "{}.{}.part".format(output_file_path, file_id)
+
+        return await self.fetch_file_content(session_id, sensor_name, file_id, partial_file_path, output_file_path)
+
+    async def fetch_file_content(self, session_id, sensor_name, file_id, partial_file_path, output_file_path):
+        '''
+        Downloads the content of a CB file into the partial file,
+        resuming it when the download breaks off, then moves it
+        to the output file.
+
+        :param session_id:
+        :param sensor_name:
+        :param file_id:
+        :param partial_file_path:
+        :param output_file_path:
+        :return results:
+        '''
+        # Variables used for the GET request.
+        request_url = '/integrationServices/v3/cblr/session/{}/file/{}/content'.format(session_id, file_id)
+
+        for attempt in range(DOWNLOAD_RETRIES):
+            try:
+                results = await self.stream_file_download(request_url, partial_file_path)
+
+            except httpx.TransportError as e:
+                print("[TASK ID: {}] Download from {} broke off: {}".format(self.TUID, sensor_name, e))
+                results = None
+
+            # CB refused to send the file.
+            if results == False:
+                break
+
+            # The file is complete, move it into the output folder.
+            if results != None:
+                os.replace(partial_file_path, output_file_path)
+                results['path'] = output_file_path
+
+                return results
+
+            await asyncio.sleep(2 ** attempt)
+
+        # Cleans up what was downloaded so far.
+        if os.path.exists(partial_file_path):
+            os.remove(partial_file_path)
+
+        return False
+
+    async def get_file_chunked(self, session_id, sensor_name, file_path, entry, output_file_path=None):
+        '''
+        Grabs a large file from CB in chunks, using the offset and
+        count of the get file command, several chunks at a time.
+        Each chunk is checkpointed in the file_chunks collection
+        once it is on disk, so chunks fetched by a failed attempt
+        or an earlier run of the sweep are not fetched again. The
+        chunks are put back together and the file is checked
+        against its hash on the endpoint.
+
+        :param session_id:
+        :param sensor_name:
+        :param file_path:
+        :param entry: directory listing entry of the file.
+        :param output_file_path:
+        :return results:
+        '''
+        size = int(entry['size'])
+
+        if output_file_path == None:
+            output_file_path = self.get_output_file_path(sensor_name, file_path)
+
+        chunk_folder = "{}.chunks".format(output_file_path)
+        os.makedirs(chunk_folder, exist_ok=True)
+
+        # Checkpoints of another version of the file are useless.
+        checkpoint = {'tuid': int(self.TUID), 'hostname': sensor_name, 'path': file_path}
+        version = '{}:{}'.format(size, entry.get('last_write_time'))
+
+        CB_BOT_DB.file_chunks.delete_many(dict(checkpoint, version={'$ne': version}))
+        done = {chunk['offset']: chunk for chunk in CB_BOT_DB.file_chunks.find(dict(checkpoint, version=version))}
+
+        chunk_slots = asyncio.Semaphore(CHUNK_CONCURRENCY)
+
+        async def fetch(offset):
+            count = min(FILE_CHUNK_SIZE, size - offset)
+            chunk_path = os.path.join(chunk_folder, '{:016x}'.format(offset))
+
+            # The chunk is already on disk from an earlier attempt.
+            if offset in done:
+                local_hash = await asyncio.get_event_loop().run_in_executor(None, get_local_hash, chunk_path)
+
+                if local_hash == (done[offset]['sha256'], count):
+                    return True
+
+            async with chunk_slots:
+                results = await self.get_file_chunk(session_id, sensor_name, file_path, offset, count, chunk_path)
+
+            if results == False or results['size'] != count:
+                return False
+
+            CB_BOT_DB.file_chunks.update_one(dict(checkpoint, version=version, offset=offset),
+                                             {'$set': {'count': count, 'sha256': results['sha256']}},
+                                             upsert=True)
+
+            return True
+
+        offsets = list(range(0, size, FILE_CHUNK_SIZE))
+        fetched = await asyncio.gather(*[fetch(offset) for offset in offsets])
+
+        if not all(fetched):
+            print("[TASK ID: {}] Fetched {} of {} chunks of {} from {}.".format(self.TUID, fetched.count(True), len(offsets), file_path, sensor_name))
+            return False
+
+        # Puts the chunks back together in a thread, since large
+        # files would hold up every other host of the sweep.
+        loop = asyncio.get_event_loop()
+        partial_file_path = "{}.part".format(output_file_path)
+        chunk_paths = [os.path.join(chunk_folder, '{:016x}'.format(offset)) for offset in offsets]
+
+        sha256 = await loop.run_in_executor(None, join_chunks, chunk_paths, partial_file_path)
+
+        remote_sha256 = await self.get_remote_sha256(session_id, sensor_name, file_path)
+        verification = 'Matches the hash on the endpoint.'
+
+        # Without the hash of the endpoint, the file is only kept if
+        # it was not changed while it was fetched. Otherwise the host
+        # is retried, and the chunks are kept if they are still good.
+        if remote_sha256 == None:
+            current = await self.get_file_entry(session_id, sensor_name, file_path)
+
+            if not current or int(current.get('size', -1)) != size or current.get('last_write_time') != entry.get('last_write_time'):
+                print("[TASK ID: {}] Could not verify {} from {}.".format(self.TUID, file_path, sensor_name))
+                os.remove(partial_file_path)
+                return False
+
+            verification = 'No hash from the endpoint. Size and last write time match the listing.'
+
+        # The chunks are only good for one try if the file does not
+        # match, since it may have changed while it was fetched.
+        await loop.run_in_executor(None, shutil.rmtree, chunk_folder, True)
+        CB_BOT_DB.file_chunks.delete_many(checkpoint)
+
+        if remote_sha256 != None and remote_sha256.lower() != sha256:
+            print("[TASK ID: {}] Hash of {} from {} does not match the endpoint.".format(self.TUID, file_path, sensor_name))
+            os.remove(partial_file_path)
+            return False
+
+        os.replace(partial_file_path, output_file_path)
+
+        return {'sha256': sha256,
+                'size': size,
+                'path': output_file_path,
+                'verified': remote_sha256 != None,
+                'verification': verification}
+
+    async def get_file_chunk(self, session_id, sensor_name, file_path, offset, count, chunk_path):
+        '''
+        Grabs one chunk of a file from CB into the chunk file.
+
+        :param session_id:
+        :param sensor_name:
+        :param file_path:
+        :param offset:
+        :param count:
+        :param chunk_path:
+        :return results:
+        '''
+
+        # Variables used for the POST request.
+        request_url = '/integrationServices/v3/cblr/session/{}/command'.format(session_id)
+
+        header = {'Content-Type': "application/json"}
+
+        body = {"session_id": session_id,
+                "name": "get file",
+                "object": file_path,
+                "offset": offset,
+                "get_count": count}
+
+        # Sends POST request to obtain the chunk
+        response = await self.client.post('command', request_url,
+                                          headers=header,
+                                          content=json.dumps(body))
+
+        if response.status_code != 200:
+            return False
+
+        # Gets the command id.
+        command_id = json.loads((response.content).decode()).get('id')
+
+        # Collects the file_id for download.
+        file_id = await self.get_file_check(session_id, sensor_name, command_id)
+
+        if file_id == False:
+            return False
+
+        return await self.fetch_file_content(session_id, sensor_name, file_id, "{}.{}.part".format(chunk_path, file_id), chunk_path)
+
+    async def get_remote_sha256(self, session_id, sensor_name, file_path):
+        '''
+        Gets the SHA256 of a file on the endpoint, using the same
+        command as the hash sweeps. Returns None if it could not
+        be hashed.
+
+        :param session_id:
+        :param sensor_name:
+        :param file_path:
+        :return sha256:
+        '''
+        if self.device_type != 'WINDOWS':
+            return None
+
+        hash_file = 'C:\\Windows\\Temp\\cb_bot_hash_{}_{}.txt'.format(self.TUID, uuid.uuid4().hex)
+        local_hash_file = os.path.join(self.get_output_folder(), '.{}'.format(hash_file.split('\\')[-1]))
+
+        if await self.command_execute(session_id, sensor_name, get_hash_command(file_path, hash_file)) != True:
+            return None
+
+        file_results = await self.get_file_request(session_id, sensor_name, hash_file, local_hash_file)
+        await self.delete_file(session_id, sensor_name, hash_file)
+
+        if file_results == False:
+            return None
+
+        # Reads the results and drops the local copy.
+        with open(file_results['path'], 'r', errors='replace') as rfile:
+            results = rfile.read().strip().split(',')
+
+        os.remove(file_results['path'])
+
+        if len(results) != 3:
+            return None
+
+        return results[0]
+
+    async def stream_file_download(self, request_url, partial_file_path):
+        '''
+        Streams a file from CB into the partial file in chunks,
+        starting after the bytes already written by an earlier
+        attempt. Returns False if CB refused to send the file,
+        and None if the download broke off.
+
+        :param request_url:
+        :param partial_file_path:
+        :return results:
+        '''
+        sha256 = hashlib.sha256()
+        size = 0
+
+        # Hashes what an earlier attempt already wrote to disk.
+        if os.path.exists(partial_file_path):
+            with open(partial_file_path, "rb") as pfile:
+                for chunk in iter(lambda: pfile.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+                    size += len(chunk)
+
+        header = {'Content-Type': "application/json"}
+
+        # Asks CB for the rest of the file only.
+        if size:
+            header['Range'] = 'bytes={}-'.format(size)
+
+        async with self.client.stream('GET', 'file_download', request_url, headers=header) as response:
+            # CB ignored the range and sent the whole file again.
+            if response.status_code == 200 and size:
+                sha256 = hashlib.sha256()
+                size = 0
+
+            elif response.status_code not in (200, 206):
+                return False
+
+            expected = response.headers.get('Content-Length')
+
+            # Writes the file to disk as it comes in.
+            with open(partial_file_path, "ab" if size else "wb") as pfile:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    pfile.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+
+            # The connection closed before the whole file came in.
+            if expected != None and response.num_bytes_downloaded != int(expected):
+                return None
+
+        return {'sha256': sha256.hexdigest(), 'size': size}
+
+    async def directory_list(self, session_id, sensor_name, path):
+        '''
+        Lists a file or folder on the system. Returns False if
+        the path is not there, and None if it could not be told.
+
+        :param session_id:
+        :param sensor_name:
+        :param path:
+        :return files:
+        '''
+
+        # Variables used for the POST request.
+        request_url = '/integrationServices/v3/cblr/session/{}/command'.format(session_id)
+
+        header = {'Content-Type': "application/json"}
+
+        body = {"session_id": session_id,
+                "name": "directory list",
+                "object": path}
+
+        # Sends POST request to list the path
+        response = await self.client.post('command', request_url,
+                                          headers=header,
+                                          content=json.dumps(body))
+
+        # Makes sure we get a successful response.
+        if response.status_code == 200:
+            # Gets the command id.
+            command_id = json.loads((response.content).decode()).get('id')
+
+            # Waits for the status poller to see the listing finish.
+            results = await self.poller.watch('command', session_id, command_id)
+
+            if results == False:
+                return None
+
+            # CB fails the listing when the path is not there.
+            if results.get('status') != "complete":
+                if results.get('result_code') in FILE_NOT_FOUND_CODES:
+                    return False
+
+                return None
+
+            return results.get('files', [])
+
+        else:
+            return None
+
+    async def get_file_entry(self, session_id, sensor_name, file_path):
+        '''
+        Lists a file on the system. Returns False if the file is
+        not there, and None if it could not be told.
+
+        :param session_id:
+        :param sensor_name:
+        :param file_path:
+        :return entry: directory listing entry of the file.
+        '''
+
+        # Variables used for the POST request.
+        request_url = '/integrationServices/v3/cblr/session/{}/command'.format(session_id)
+
+        header = {'Content-Type': "application/json"}
+
+        body = {"session_id": session_id,
+                "name": "directory list",
+                "object": file_path}
+
+        # Sends POST request to list the file
+        response = await self.client.post('command', request_url,
+                                          headers=header,
+                                          content=json.dumps(body))
+
+        if response.status_code != 200:
+            return None
+
+        # Gets the command id.
+        command_id = json.loads((response.content).decode()).get('id')
+
+        # Waits for the status poller to see the listing finish.
+        results = await self.poller.watch('command', session_id, command_id)
+
+        if results == False:
+            return None
+
+        # CB fails the listing when the path is not there.
+        if results.get('status') == "error":
+            if results.get('result_code') in FILE_NOT_FOUND_CODES:
+                return False
+
+            return None
+
+        file_name = file_path.split('\\')[-1].lower()
+
+        for entry in results.get('files', []):
+            if str(entry.get('filename', '')).lower() == file_name and 'DIRECTORY' not in entry.get('attributes', []):
+                return entry
+
+        return False
+
+    async def expand_path(self, session_id, sensor_name, path):
+        '''
+        Expands the wildcards in the folders of a path, since CB
+        only allows them in the last part. For example, a path
+        like C:\\Users\\*\\AppData\\Roaming\\ becomes one path per
+        user folder.
+
+        :param session_id:
+        :param sensor_name:
+        :param path:
+        :return paths: list of paths, or None if a folder could
+                       not be listed.
+        '''
+        parts = path.split('\\')
+        paths = [parts[0]]
+
+        for part in parts[1:-1]:
+            if '*' not in part and '?' not in part:
+                paths = ['{}\\{}'.format(folder, part) for folder in paths]
+                continue
+
+            # Lists the matching folders one level down.
+            matches = list()
+
+            for folder in paths:
+                files = await self.directory_list(session_id, sensor_name, '{}\\{}'.format(folder, part))
+
+                if files == None:
+                    return None
+
+                for entry in files or []:
+                    if 'DIRECTORY' in entry.get('attributes', []) and entry.get('filename') not in ('.', '..'):
+                        matches.append('{}\\{}'.format(folder, entry['filename']))
+
+            paths = matches
+
+        return ['{}\\{}'.format(folder, parts[-1]) for folder in paths]
+
+    async def find_files(self, session_id, sensor_name, pattern):
+        '''
+        Gets the files on the system that match a path, which
+        can have wildcards in any part of it.
+
+        :param session_id:
+        :param sensor_name:
+        :param pattern:
+        :return paths: dictionary of path: directory listing entry,
+                       or None if the path could not be listed.
+        '''
+        paths = dict()
+        expanded_paths = await self.expand_path(session_id, sensor_name, pattern)
+
+        if expanded_paths == None:
+            return None
+
+        for path in expanded_paths:
+            # Paths without wildcards only need to be checked.
+            if '*' not in path and '?' not in path:
+                entry = await self.get_file_entry(session_id, sensor_name, path)
+
+                if entry != False:
+                    paths[path] = entry
+
+                continue
+
+            folder = path.rsplit('\\', 1)[0]
+            files = await self.directory_list(session_id, sensor_name, path)
+
+            if files == None:
+                return None
+
+            for entry in files or []:
+                if 'DIRECTORY' not in entry.get('attributes', []):
+                    paths['{}\\{}'.format(folder, entry.get('filename'))] = entry
+
+        return paths
+
+    async def collect_files(self, host):
+        '''
+        Collects every file matching the paths of the sweep into
+        a folder for the host, several at a time in the session.
+        The status of each file is kept in the sweep log, and a
+        retry only fetches the files that were not collected yet.
+
+        :param host:
+        '''
+        host_folder = os.path.join(self.get_output_folder(), host['sensor_name'].replace(' ', '_'))
+        sweep_log = CB_BOT_DB.sweep_log.find_one({'_id': host['host_object_id']}, {'files': 1}) or {}
+        collected = {entry['path']: entry for entry in sweep_log.get('files', []) if entry['status'] == 'Collected'}
+
+        matches = dict()
+
+        for pattern in self.file_patterns:
+            found = await self.find_files(host['session_id'], host['sensor_name'], pattern)
+
+            # The host is left incomplete so it is tried again.
+            if found == None:
+                return self.update_one_host_sweep('status', 'Could not list {}.'.format(pattern), host['host_object_id'])
+
+            for path, entry in found.items():
+                if path.lower() not in [match.lower() for match in matches]:
+                    matches[path] = entry
+
+        fetch_slots = asyncio.Semaphore(FILE_FETCH_CONCURRENCY)
+
+        async def fetch(path):
+            if path in collected:
+                return collected[path]
+
+            # Keeps the folders of the endpoint under the host
+            # folder, so files with the same name do not clash.
+            output_file_path = os.path.join(host_folder, *path.replace(':', '').split('\\'))
+
+            async with fetch_slots:
+                results = await self.get_file_request(host['session_id'], host['sensor_name'], path, output_file_path, matches[path])
+
+            if results == False:
+                return {'path': path, 'status': 'Unable to collect file!'}
+
+            collected_file = {'path': path,
+                              'status': 'Collected',
+                              'sha256': results['sha256'],
+                              'size': results['size']}
+
+            # Files fetched in chunks record how they were checked.
+            if 'verified' in results:
+                collected_file['verified'] = results['verified']
+                collected_file['verification'] = results['verification']
+
+            return collected_file
+
+        files = await asyncio.gather(*[fetch(path) for path in matches])
+        self.update_one_host_sweep('files', list(files), host['host_object_id'])
+
+        if not files:
+            self.update_one_host_sweep('file_present', False, host['host_object_id'])
+            return self.complete_host(host, 'File not present.')
+
+        collected_count = len([entry for entry in files if entry['status'] == 'Collected'])
+
+        if collected_count == len(files):
+            return self.complete_host(host, 'Collected {} files.'.format(collected_count))
+
+        self.update_one_host_sweep('status', 'Collected {} of {} files.'.format(collected_count, len(files)), host['host_object_id'])
+
+    def get_output_folder(self):
+        '''
+        Gets the folder collected files of the sweep go in.
+
+        :return output_folder:
+        '''
+
+        return "{}/{}_{}".format(OUTPUT_DIRECTORY, self.TUID, (self.sweep_name).replace(' ', '_'))
+
+    def get_output_file_path(self, sensor_name, file_path):
+        '''
+        Gets the path a file collected from a host is saved to
+        in the output folder of the sweep.
+
+        :param sensor_name:
+        :param file_path:
+        :return output_file_path:
+        '''
+        hunt_file_stripped = ((file_path).split('\\')[-1]).replace(' ', '_')
+        output_filename = "{}_{}".format(sensor_name, hunt_file_stripped)
+
+        return "{}/{}".format(self.get_output_folder(), output_filename)
+
+    async def collect_listing(self, host):
+        '''
+        Lists the path of the sweep on the host and stores every
+        entry in the directory_listings collection. Nothing is
+        written to or deleted from the endpoint.
+
+        :param host:
+        '''
+        entry_count = 0
+        listed = False
+
+        # Drops what an earlier attempt on the host stored.
+        CB_BOT_DB.directory_listings.delete_many({'tuid': int(self.TUID), 'device_id': int(host['sensor_id'])})
+
+        paths = await self.expand_path(host['session_id'], host['sensor_name'], self.list_path)
+
+        for path in paths or []:
+            files = await self.directory_list(host['session_id'], host['sensor_name'], path)
+
+            if files == None:
+                paths = None
+                break
+
+            if files == False:
+                continue
+
+            listed = True
+
+            # Stores the listing of each folder as it comes in.
+            entry_count += self.store_listing(host, path, files)
+
+        # The host is left incomplete so it is tried again.
+        if paths == None:
+            return self.update_one_host_sweep('status', 'Could not list {}.'.format(self.list_path), host['host_object_id'])
+
+        if listed == False:
+            return self.complete_host(host, 'Path not present.')
+
+        self.complete_host(host, 'Listed {} entries.'.format(entry_count))
+
+    def store_listing(self, host, path, files):
+        '''
+        Stores the entries of a directory listing in the
+        directory_listings collection.
+
+        :param host:
+        :param path:
+        :param files:
+        :return entry_count:
+        '''
+        folder = path.rsplit('\\', 1)[0]
+
+        entries = [{'tuid': int(self.TUID),
+                    'device_id': int(host['sensor_id']),
+                    'hostname': host['sensor_name'],
+                    'path': '{}\\{}'.format(folder, entry.get('filename')),
+                    'size': entry.get('size'),
+                    'attributes': entry.get('attributes', []),
+                    'create_time': entry.get('create_time'),
+                    'last_access_time': entry.get('last_access_time'),
+                    'last_write_time': entry.get('last_write_time')}
+                   for entry in files if entry.get('filename') not in ('.', '..')]
+
+        if entries:
+            CB_BOT_DB.directory_listings.insert_many(entries, ordered=False)
+
+        return len(entries)
+
+    async def run_steps(self, host):
+        '''
+        Runs the steps of a pipeline sweep one after the other
+        in the session of the host, and records how each one
+        went in the sweep log. A failed step stops the pipeline,
+        unless the step is optional, but the 'delete' steps
+        still run so nothing is left behind on the host.
+
+        :param host:
+        '''
+        step_results = list()
+        failed_step = None
+
+        # Drops what an earlier attempt on the host listed.
+        CB_BOT_DB.directory_listings.delete_many({'tuid': int(self.TUID), 'device_id': int(host['sensor_id'])})
+
+        for index, step in enumerate(self.steps):
+            if failed_step != None and step['action'] != 'delete':
+                continue
+
+            try:
+                success, detail = await self.run_step(host, index, step)
+
+            except Exception as e:
+                success, detail = False, 'Error: {}'.format(e)
+
+            step_results.append({'action': step['action'], 'success': success, 'detail': detail})
+
+            if success == False and not step.get('optional', False) and failed_step == None:
+                failed_step = index
+
+        self.update_one_host_sweep('steps', step_results, host['host_object_id'])
+
+        succeeded = len([result for result in step_results if result['success']])
+
+        if failed_step != None:
+            return self.update_one_host_sweep('status', 'Step {} ({}) failed. {} of {} steps succeeded.'.format(failed_step + 1,
+                                                                                                          self.steps[failed_step]['action'],
+                                                                                                          succeeded,
+                                                                                                          len(self.steps)), host['host_object_id'])
+
+        self.complete_host(host, '{} of {} steps succeeded.'.format(succeeded, len(self.steps)))
+
+    async def run_step(self, host, index, step):
+        '''
+        Runs one step of a pipeline sweep. The steps are:
+
+            - put: Uploads 'file', a path on the cb-bot server,
+              to 'path' on the host.
+            - execute: Runs 'command'.
+            - get: Collects the files in 'paths' (or 'path').
+            - delete: Deletes the files in 'paths' (or 'path').
+            - list: Lists 'path' into directory_listings.
+
+        :param host:
+        :param index:
+        :param step:
+        :return success, detail:
+        '''
+        session_id = host['session_id']
+        sensor_name = host['sensor_name']
+        paths = step.get('paths') or [step.get('path')]
+
+        if step['action'] == 'put':
+            payload = self.step_payloads[index]
+            success = await self.upload_file_to_cb(session_id, sensor_name, payload, step['path'])
+
+            return success == True, '{} to {}'.format(payload.name, step['path'])
+
+        if step['action'] == 'execute':
+            success = await self.command_execute(session_id, sensor_name, step['command'])
+
+            return success == True, step['command']
+
+        if step['action'] == 'get':
+            collected = 0
+
+            for path in paths:
+                if await self.get_file_request(session_id, sensor_name, path) != False:
+                    collected += 1
+
+            return collected == len(paths), '{} of {} files collected.'.format(collected, len(paths))
+
+        if step['action'] == 'delete':
+            for path in paths:
+                await self.delete_file(session_id, sensor_name, path)
+
+            return True, '{} files deleted.'.format(len(paths))
+
+        if step['action'] == 'list':
+            files = await self.directory_list(session_id, sensor_name, step['path'])
+
+            if files == None:
+                return False, 'Could not list the path.'
+
+            if files == False:
+                return False, 'Path not present.'
+
+            return True, 'Listed {} entries.'.format(self.store_listing(host, step['path'], files))
+
+        return False, 'Unknown action.'
+
+    async def process_list(self, session_id, sensor_name):
+        '''
+        Lists the processes running on the system.
+
+        :param session_id:
+        :param sensor_name:
+        :return processes:
+        '''
+        command_id = await self.queue_command(session_id, {"session_id": session_id,
+                                                           "name": "process list"})
+
+        if command_id == False:
+            return False
+
+        # Waits for the status poller to see the listing finish.
+        results = await self.poller.watch('command', session_id, command_id)
+
+        if results == False or results.get('status') != "complete":
+            return False
+
+        return results.get('processes', [])
+
+    async def collect_processes(self, host):
+        '''
+        Lists the processes running on the host with a single
+        CB command and stores them in the process_lists
+        collection, one document per process.
+
+        :param host:
+        '''
+        processes = await self.process_list(host['session_id'], host['sensor_name'])
+
+        if processes == False:
+            return self.update_one_host_sweep('status', 'Unable to list the processes.', host['host_object_id'])
+
+        # Paths of the processes, to name the parent of each one.
+        paths = {process.get('pid'): process.get('path', '') for process in processes}
+
+        entries = [{'tuid': int(self.TUID),
+                    'device_id': int(host['sensor_id']),
+                    'hostname': host['sensor_name'],
+                    'pid': process.get('pid'),
+                    'path': process.get('path', ''),
+                    'process_name': process.get('path', '').split('\\')[-1].split('/')[-1].lower(),
+                    'command_line': process.get('command_line', ''),
+                    'parent_pid': process.get('parent'),
+                    'parent_path': paths.get(process.get('parent'), ''),
+                    'username': process.get('username', ''),
+                    'sid': process.get('sid', ''),
+                    'create_time': process.get('create_time')}
+                   for process in processes]
+
+        # Drops what an earlier attempt on the host stored.
+        CB_BOT_DB.process_lists.delete_many({'tuid': int(self.TUID), 'device_id': int(host['sensor_id'])})
+
+        if entries:
+            CB_BOT_DB.process_lists.insert_many(entries, ordered=False)
+
+        self.complete_host(host, 'Listed {} processes.'.format(len(entries)))
+
+    async def registry_query(self, session_id, sensor_name, registry_path):
+        '''
+        Reads a registry key, or one of its values when the path
+        ends with '::<value name>'. Returns False if the key or
+        value is not there, and None if it could not be told.
+
+        :param session_id:
+        :param sensor_name:
+        :param registry_path:
+        :return results:
+        '''
+
+        if '::' in registry_path:
+            key, value_name = registry_path.rsplit('::', 1)
+            body = {"session_id": session_id,
+                    "name": "reg query value",
+                    "object": '{}\\{}'.format(key, value_name)}
+
+        else:
+            body = {"session_id": session_id,
+                    "name": "reg enum key",
+                    "object": registry_path}
+
+        command_id = await self.queue_command(session_id, body)
+
+        if command_id == False:
+            return None
+
+        # Waits for the status poller to see the query finish.
+        results = await self.poller.watch('command', session_id, command_id)
+
+        if results == False:
+            return None
+
+        # CB fails the query when the key or value is not there.
+        if results.get('status') != "complete":
+            if results.get('result_code') in FILE_NOT_FOUND_CODES:
+                return False
+
+            return None
+
+        return results
+
+    async def collect_registry(self, host):
+        '''
+        Reads the registry keys and values of the sweep on the
+        host and stores them in the registry_values collection,
+        one document per key or value. Nothing is written to
+        the endpoint.
+
+        :param host:
+        '''
+        entries = list()
+
+        for registry_path in self.registry_paths:
+            results = await self.registry_query(host['session_id'], host['sensor_name'], registry_path)
+
+            # The host is left incomplete so it is tried again.
+            if results == None:
+                return self.update_one_host_sweep('status', 'Could not read {}.'.format(registry_path), host['host_object_id'])
+
+            # The key or value is not on the host.
+            if results == False:
+                continue
+
+            entry = {'tuid': int(self.TUID),
+                     'device_id': int(host['sensor_id']),
+                     'hostname': host['sensor_name'],
+                     'key': registry_path.split('::')[0]}
+
+            if '::' in registry_path:
+                entry['values'] = [results.get('value', {})]
+
+            else:
+                entry['sub_keys'] = results.get('sub_keys', [])
+                entry['values'] = results.get('values', [])
+
+            entries.append(entry)
+
+        # Drops what an earlier attempt on the host stored.
+        CB_BOT_DB.registry_values.delete_many({'tuid': int(self.TUID), 'device_id': int(host['sensor_id'])})
+
+        if entries:
+            CB_BOT_DB.registry_values.insert_many(entries, ordered=False)
+
+            return self.complete_host(host, 'Read {} of {} registry paths.'.format(len(entries), len(self.registry_paths)))
+
+        self.complete_host(host, 'Registry paths not present.')
+
+    async def check_staged_payload(self, host):
+        '''
+        Checks if the upload file of this sweep is already on
+        the host. The hash of the file staged on the host is
+        tracked in Mongo, and the size and last write time
+        on the host have to still match what was staged.
+
+        :param host:
+        :return staged:
+        '''
+        staged = CB_BOT_DB.staged_payloads.find_one({'device_id': int(host['sensor_id']),
+                                                     'path': self.remote_upload_file})
+
+        # A different version of the file, or nothing, was staged.
+        if staged == None or staged.get('sha256') != self.payload.sha256:
+            return False
+
+        files = await self.directory_list(host['session_id'], host['sensor_name'], self.remote_upload_file)
+
+        # The file is gone from the host.
+        if not files:
+            return False
+
+        return (files[0].get('size') == staged.get('size') and
+                files[0].get('last_write_time') == staged.get('last_write_time'))
+
+    async def unstage_payload(self, host):
+        '''
+        Deletes the upload file that an earlier sweep left
+        staged on the host, if any, and forgets about it. The
+        record is dropped even if the delete failed, so the
+        file is not trusted as staged later on.
+
+        :param host:
+        :return deleted: None if nothing was staged.
+        '''
+        query = {'device_id': int(host['sensor_id']), 'path': self.remote_upload_file}
+
+        if CB_BOT_DB.staged_payloads.find_one(query) == None:
+            return None
+
+        CB_BOT_DB.staged_payloads.delete_one(query)
+
+        body = {"session_id": host['session_id'],
+                "name": "delete file",
+                "object": self.remote_upload_file}
+
+        command_id = await self.queue_command(host['session_id'], body)
+
+        if command_id == False:
+            return False
+
+        # Waits for the status poller to see the delete finish.
+        results = await self.poller.watch('command', host['session_id'], command_id)
+
+        if results == False:
+            return False
+
+        # The file is already gone from the host.
+        return results.get('status') == "complete" or results.get('result_code') in FILE_NOT_FOUND_CODES
+
+    async def record_staged_payload(self, host):
+        '''
+        Records the version of the upload file that is now
+        staged on the host.
+
+        :param host:
+        '''
+        files = await self.directory_list(host['session_id'], host['sensor_name'], self.remote_upload_file)
+
+        if not files:
+            return
+
+        CB_BOT_DB.staged_payloads.update_one({'device_id': int(host['sensor_id']),
+                                              'path': self.remote_upload_file},
+                                             {'$set': {'sha256': self.payload.sha256,
+                                                       'size': files[0].get('size'),
+                                                       'last_write_time': files[0].get('last_write_time'),
+                                                       'tuid': int(self.TUID),
+                                                       'staged': datetime.datetime.utcnow()}},
+                                             upsert=True)
+
+    async def collect_hash(self, host):
+        '''
+        Collects the hashes and size of the file written by the
+        hash command, records them in the sweep log, and only
+        downloads the file itself if a hash is a target.
+
+        :param host:
+        '''
+        # Only the results of the hash command are deleted, the
+        # hashed file is left alone.
+        host['delete_files'] = [self.out_file]
+
+        file_results = await self.get_file_request(host['session_id'], host['sensor_name'])
+
+        if file_results == False:
+            return self.update_one_host_sweep('status', 'Command ran, but was unable to collect results.', host['host_object_id'])
+
+        # Reads the results and drops the local copy.
+        with open(file_results['path'], 'r', errors='replace') as rfile:
+            results = rfile.read().strip().split(',')
+
+        os.remove(file_results['path'])
+
+        if len(results) != 3:
+            return self.complete_host(host, 'File not present.')
+
+        sha256, md5, size = results[0].upper(), results[1].upper(), int(results[2])
+
+        self.update_one_host_sweep('sha256', sha256, host['host_object_id'])
+        self.update_one_host_sweep('md5', md5, host['host_object_id'])
+        self.update_one_host_sweep('file_size', size, host['host_object_id'])
+
+        if sha256 not in TARGET_HASHES and md5 not in TARGET_HASHES:
+            return self.complete_host(host, 'File present. SHA256: {}'.format(sha256))
+
+        # The hash is a target, collect the file too.
+        if await self.get_file_request(host['session_id'], host['sensor_name'], self.hash_file) == False:
+            return self.update_one_host_sweep('status', 'Hash matched a target, but was unable to collect the file.', host['host_object_id'])
+
+        self.complete_host(host, 'Hash matched a target. File collected! SHA256: {}'.format(sha256))
+
+    async def compress_file(self, session_id, sensor_name, file_path):
+        '''
+        Compresses a file on the endpoint next to the original,
+        as a zip archive on Windows and with gzip elsewhere.
+
+        :param session_id:
+        :param sensor_name:
+        :param file_path:
+        :return archive_path:
+        '''
+
+        if self.device_type == 'WINDOWS':
+            archive_path = '{}.zip'.format(file_path)
+
+            # Single quotes are escaped by doubling them in PowerShell.
+            command = ('powershell.exe -NoProfile -Command "Compress-Archive -LiteralPath \'{}\' '
+                       '-DestinationPath \'{}\' -Force"').format(file_path.replace("'", "''"),
+                                                                   archive_path.replace("'", "''"))
+
+        else:
+            archive_path = '{}.gz'.format(file_path)
+            command = 'gzip -f -k {}'.format(shlex.quote(file_path))
+
+        command_id = await self.queue_command(session_id, {"session_id": session_id,
+                                                           "name": "create process",
+                                                           "wait": "true",
+                                                           "object": command})
+
+        # Waits for the archive to be written.
+        if command_id == False or not await self.command_check(session_id, sensor_name, command_id):
+            return False
+
+        return archive_path
+
+    def decompress_file(self, archive_path):
+        '''
+        Extracts a collected archive next to it in chunks,
+        hashing the extracted file on the way, and removes
+        the archive.
+
+        :param archive_path:
+        :return results:
+        '''
+        output_file_path = os.path.splitext(archive_path)[0]
+        sha256 = hashlib.sha256()
+        size = 0
+
+        if archive_path.endswith('.zip'):
+            afile = zipfile.ZipFile(archive_path)
+            source = afile.open(afile.namelist()[0])
+
+        else:
+            afile = gzip.open(archive_path, 'rb')
+            source = afile
+
+        with afile, source, open(output_file_path, 'wb') as ofile:
+            for chunk in iter(lambda: source.read(DOWNLOAD_CHUNK_SIZE), b''):
+                ofile.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+
+        os.remove(archive_path)
+
+        return {'sha256': sha256.hexdigest(), 'size': size, 'path': output_file_path}
+
+    def get_sweep_log_host_id(self, device_id):
+        '''
+        Gets the host information for one host host in the
+        sweep_log from the MongoDB database.
+        '''
+        # Queries Mongo for the host in the sweep_log.
+        return CB_BOT_DB.sweep_log.find_one({"device_id": int(device_id), "tuid": int(self.TUID)})['_id']
+
+    def update_one_host_sweep(self, data_type, data_value, _id):
+        '''
+        Updated a field for a host in the sweep_log collection.
+
+        :param data_type:
+        :param data_value:
+        :param _id:
+        '''
+
+        # Updates the record for a host in the sweep_log collection.
+        CB_BOT_DB.sweep_log.update_one({'_id': _id},
+                                     {'$set': {data_type: data_value}},
+                                     upsert=False)
+
+    async def get_host_last_reported_time(self, sensor_id):
+        '''
+        This queries the CB API for the host's last reported
+        timestamp. Once we have that we can cross check the
+        minimum checking time selected. Hosts in the device
+        snapshot are looked up locally without an API call.
+        '''
+        # Checks the device snapshot first.
+        last_reported = self.snapshot.get_last_reported_time(sensor_id)
+
+        if last_reported != None:
+            return last_reported
+
+        # Variables used for the GET request.
+        request_url = '/integrationServices/v3/device/{}'.format(sensor_id)
+
+        # Sends GET request to check on a CB Session
+        response = await self.client.get('device', request_url)
+
+        # Check if it was a valid response.
+        if response.status_code == 200:
+            # This is to check if the sensor is listed. Most likely yes.
+            results = json.loads((response.content).decode())
+
+            # Confirms if there is an active LR Session or not.
+            # If it says PENDING, we should wait for a session
+            # ID to spin up. 
+            if results.get('success') == True:
+                return datetime.datetime.utcfromtimestamp((int(results['deviceInfo']['lastReportedTime'])/1000))
+
+        # The device is unknown to CB, like a deregistered sensor.
+        return False
+
+    def update_completed_hosts_task(self):
+        '''
+        Updates the count of hosts that have been completed
+        on a particular sweep.
+        '''
+        # Check on completed host count
+        completed_count = len(list(CB_BOT_DB.sweep_log.find({"tuid": int(self.TUID), "complete": True})))
+
+        # Change the completed_hosts count on the specific task.
+        update_task('completed_hosts', completed_count, self.task_object_id)
+
+    async def delete_file(self, session_id, sensor_name, file_to_delete):
+        '''
+        Deletes the file created on disk.
+        '''
+        # # Debug Log
+        # print("[RUNNING] Grabbing output file on %s" % (sensor_name))
+
+        # Variables used for the POST request.
+        request_url = '/integrationServices/v3/cblr/session/{}/command'.format(session_id)
+
+        header = {'Content-Type': "application/json"}
+
+        body = {"session_id": session_id,
+                "name": "delete file",
+                "object": file_to_delete}
+
+        # Sends POST request to obtain a file
+        response = await self.client.post('command', request_url,
+                                          headers=header,
+                                          content=json.dumps(body))
+
+        # Makes sure we get a successful response.
+        if response.status_code == 200:
+            # print("[DONE] File deleted on %s" % (sensor_name))
+            return
+
+        else:
+            # print("[ERROR] Error encountered deleting '%s' from %s" % (output_file, sensor_name))
+            # ERROR_HOSTS.append({sensor_name:session_id.split(':')[1]})
+            return
+
+
+class UPLOAD_PAYLOAD():
+    '''
+    File pushed to every host by a type 2 sweep. It is opened,
+    memory-mapped and hashed once, and every upload streams a
+    multipart body from the same mapping, so memory use does
+    not grow with the size of the file or the number of hosts.
+    '''
+
+    def __init__(self, path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.chunk_size = chunk_size
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+
+        # Empty files cannot be memory-mapped.
+        if self.size:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b''
+
+        # Hashes the file once for the whole sweep.
+        sha256 = hashlib.sha256()
+
+        for offset in range(0, self.size, self.chunk_size):
+            sha256.update(self.data[offset:offset + self.chunk_size])
+
+        self.sha256 = sha256.hexdigest()
+
+        # Multipart framing around the file content.
+        self.boundary = uuid.uuid4().hex
+        self.head = ('--{}\r\n'
+                     'Content-Disposition: form-data; name="file"; filename="{}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n').format(self.boundary, self.name).encode()
+        self.tail = '\r\n--{}--\r\n'.format(self.boundary).encode()
+
+    def close(self):
+        '''
+        Unmaps and closes the file.
+        '''
+
+        if self.size:
+            self.data.close()
+
+        self.file.close()
+
+    def get_content_type(self):
+        '''
+        Gets the Content-Type header of the multipart body.
+
+        :return content_type:
+        '''
+
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def get_content_length(self):
+        '''
+        Gets the size in bytes of the multipart body.
+
+        :return content_length:
+        '''
+
+        return len(self.head) + self.size + len(self.tail)
+
+    async def get_multipart(self):
+        '''
+        Streams the multipart body in chunks.
+
+        :return chunks:
+        '''
+        yield self.head
+
+        for offset in range(0, self.size, self.chunk_size):
+            yield self.data[offset:offset + self.chunk_size]
+
+        yield self.tail
+
+
+class SESSION_REGISTRY():
+    '''
+    Shares CB sessions between the sweeps that run at the same
+    time. Each sweep using the session of a device holds a claim
+    on it in the lr_sessions collection, refreshed while the
+    sweep runs. Claims of sweeps that were stopped or died go
+    stale after 'lease_timeout' seconds.
+
+    Once the last live claim on a session is released, the
+    session is kept warm for 'idle_window' seconds so it can be
+    joined again. The sweep that released it last keeps track of
+    it in self.idle, least recently used first, and closes it
+    once it expires or the session budget is needed.
+    '''
+
+    def __init__(self, tuid, lease_timeout, idle_window):
+        self.claim_key = 'claims.{}'.format(tuid)
+        self.tuid = str(tuid)
+        self.lease_timeout = lease_timeout
+        self.idle_window = idle_window
+        self.idle = collections.OrderedDict()
+
+        CB_BOT_DB.lr_sessions.create_index('device_id', unique=True)
+
+    def get_live_claims(self, session):
+        '''
+        Gets the sweeps with a live claim on a session.
+
+        :param session:
+        :return tuids:
+        '''
+        stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.lease_timeout)
+
+        return [tuid for tuid, heartbeat in session.get('claims', {}).items() if heartbeat > stale]
+
+    def join(self, device_id):
+        '''
+        Claims the session on the device that another running
+        sweep is using, that is being kept warm, or that an
+        earlier run of this task left behind.
+
+        :param device_id:
+        :return session_id:
+        '''
+        session = CB_BOT_DB.lr_sessions.find_one({'device_id': int(device_id)})
+
+        if session == None:
+            return None
+
+        in_use = [tuid for tuid in self.get_live_claims(session) if tuid != self.tuid]
+        warm = session.get('idle_since') and session['idle_since'] > datetime.datetime.utcnow() - datetime.timedelta(seconds=self.idle_window)
+        left_behind = self.tuid in session.get('claims', {})
+
+        if not (in_use or warm or left_behind):
+            return None
+
+        results = CB_BOT_DB.lr_sessions.update_one({'_id': session['_id'], 'session_id': session['session_id']},
+                                                   {'$set': {self.claim_key: datetime.datetime.utcnow()},
+                                                    '$unset': {'idle_since': '', 'released_by': ''}})
+
+        # The session was closed in the meantime.
+        if results.matched_count == 0:
+            return None
+
+        self.idle.pop(int(device_id), None)
+
+        return session['session_id']
+
+    def claim(self, device_id, session_id):
+        '''
+        Claims a session that this sweep opened.
+
+        :param device_id:
+        :param session_id:
+        '''
+        timestamp = datetime.datetime.utcnow()
+
+        results = CB_BOT_DB.lr_sessions.update_one({'device_id': int(device_id), 'session_id': session_id},
+                                                   {'$set': {self.claim_key: timestamp}})
+
+        # Replaces whatever was left from an older session.
+        if results.matched_count == 0:
+            try:
+                CB_BOT_DB.lr_sessions.update_one({'device_id': int(device_id)},
+                                                 {'$set': {'session_id': session_id,
+                                                           'claims': {self.tuid: timestamp}}},
+                                                 upsert=True)
+
+            except pymongo.errors.DuplicateKeyError:
+                self.claim(device_id, session_id)
+
+    def release(self, device_id, session_id, keep_warm=True):
+        '''
+        Drops the claim of this sweep on a session. If no other
+        sweep uses the session, it is kept warm, or removed if
+        'keep_warm' is False.
+
+        :param device_id:
+        :param session_id:
+        :param keep_warm:
+        :return close: True if the session has to be closed now.
+        '''
+        session = CB_BOT_DB.lr_sessions.find_one_and_update({'device_id': int(device_id), 'session_id': session_id},
+                                                            {'$unset': {self.claim_key: ''}},
+                                                            return_document=pymongo.ReturnDocument.AFTER)
+
+        if session == None:
+            return True
+
+        if self.get_live_claims(session):
+            return False
+
+        # Only touches the session if nobody joined it meanwhile.
+        if keep_warm and self.idle_window > 0:
+            # Mongo keeps milliseconds only.
+            idle_since = datetime.datetime.utcnow()
+            idle_since = idle_since.replace(microsecond=idle_since.microsecond // 1000 * 1000)
+
+            # The session reaper closes it if this sweep dies.
+            results = CB_BOT_DB.lr_sessions.update_one({'_id': session['_id'], 'claims': session.get('claims', {})},
+                                                       {'$set': {'idle_since': idle_since,
+                                                                 'released_by': self.tuid}})
+
+            if results.modified_count == 1:
+                self.idle[int(device_id)] = (session_id, idle_since)
+
+            return False
+
+        results = CB_BOT_DB.lr_sessions.delete_one({'_id': session['_id'], 'claims': session.get('claims', {})})
+
+        return results.deleted_count == 1
+
+    def reap(self, needed=0):
+        '''
+        Takes the idle sessions to close: the ones idle for
+        longer than the idle window, then the least recently
+        used ones until 'needed' sessions are taken. Sessions
+        that another sweep joined in the meantime are skipped.
+
+        :param needed:
+        :return sessions: list of (device_id, session_id).
+        '''
+        expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.idle_window)
+        sessions = list()
+
+        for device_id, (session_id, idle_since) in list(self.idle.items()):
+            if idle_since > expired and len(sessions) >= needed:
+                break
+
+            del self.idle[device_id]
+
+            results = CB_BOT_DB.lr_sessions.delete_one({'device_id': device_id,
+                                                        'session_id': session_id,
+                                                        'idle_since': idle_since})
+
+            if results.deleted_count == 1:
+                sessions.append((device_id, session_id))
+
+        return sessions
+
+    async def run(self):
+        '''
+        Refreshes the claims of this sweep for as long as it
+        is running.
+        '''
+
+        while True:
+            await asyncio.sleep(self.lease_timeout / 4)
+
+            CB_BOT_DB.lr_sessions.update_many({self.claim_key: {'$exists': True}},
+                                              {'$set': {self.claim_key: datetime.datetime.utcnow()}})
+
+
+class RETRY_QUEUE():
+    '''
+    Queue of hosts to sweep. Hosts that failed are kept in a
+    heap ordered by the time they are eligible again, and are
+    only handed out to the workers once that time has come.
+    '''
+
+    def __init__(self, max_attempts, backoff):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.ready = asyncio.Queue()
+        self.delayed = list()
+        self.attempts = dict()
+        self.parked = dict()
+        self.unfinished = 0
+        self.finished = asyncio.Event()
+        self.wakeup = asyncio.Event()
+
+    def qsize(self):
+        '''
+        Gets the number of hosts left, eligible or not.
+
+        :return size:
+        '''
+
+        return self.ready.qsize() + len(self.delayed) + len(self.parked)
+
+    def get_items(self):
+        '''
+        Gets every host left in the queue, eligible or not.
+
+        :return items:
+        '''
+        items = list()
+
+        while not self.ready.empty():
+            items.append(self.ready.get_nowait())
+
+        return items + [item for due, attempts, item in self.delayed] + list(self.parked)
+
+    def put_nowait(self, item):
+        '''
+        Adds a host that is eligible right away.
+
+        :param item:
+        '''
+        self.unfinished += 1
+        self.finished.clear()
+        self.ready.put_nowait(item)
+
+    def put_back(self, item):
+        '''
+        Puts a host taken from the queue back without counting
+        it as a new host.
+
+        :param item:
+        '''
+        self.ready.put_nowait(item)
+
+    def park(self, item, last_reported):
+        '''
+        Parks an offline host until the device snapshot shows
+        it reported in after 'last_reported'. Parked hosts do
+        not cost anything until they are woken up.
+
+        :param item:
+        :param last_reported:
+        '''
+        self.unfinished += 1
+        self.parked[item] = last_reported
+
+    def wake(self, snapshot):
+        '''
+        Hands the parked hosts that have checked in since they
+        were parked back to the workers. Parked hosts that are
+        not in the snapshot anymore, like deregistered sensors,
+        would never check in, so they are taken out and given
+        back to be marked as done.
+
+        :param snapshot:
+        :return gone: hosts that are not in the snapshot.
+        '''
+        gone = list()
+
+        for item, last_reported in list(self.parked.items()):
+            reported = snapshot.get_last_reported_time(item.split('||')[1])
+
+            # An empty snapshot is more likely a bad refresh.
+            if reported == None and len(snapshot.devices) > 0:
+                del self.parked[item]
+                gone.append(item)
+
+            elif reported and (last_reported == False or reported > last_reported):
+                del self.parked[item]
+                self.ready.put_nowait(item)
+
+        return gone
+
+    def retry(self, item, failure):
+        '''
+        Schedules another attempt for a host. Returns the number
+        of attempts made so far, or False if the host has used up
+        all of its attempts.
+
+        :param item:
+        :param failure:
+        :return attempts:
+        '''
+        attempts = self.attempts.get(item, 0) + 1
+        self.attempts[item] = attempts
+
+        if attempts >= self.max_attempts:
+            return False
+
+        # The delay doubles with every attempt, with some jitter
+        # so hosts that failed together are not retried together.
+        backoff = self.backoff.get(failure, self.backoff['error'])
+        delay = min(backoff['ceiling'], backoff['delay'] * 2 ** (attempts - 1))
+        delay *= random.uniform(0.9, 1.1)
+
+        self.unfinished += 1
+        heapq.heappush(self.delayed, (asyncio.get_running_loop().time() + delay, attempts, item))
+        self.wakeup.set()
+
+        return attempts
+
+    async def get(self):
+        '''
+        Gets the next host that is eligible right now.
+
+        :return item:
+        '''
+
+        return await self.ready.get()
+
+    def task_done(self):
+        '''
+        Marks a host taken from the queue as done.
+        '''
+        self.unfinished -= 1
+
+        if self.unfinished == 0:
+            self.finished.set()
+
+    async def join(self):
+        '''
+        Waits until every host is done and no retry is left.
+        '''
+
+        if self.unfinished > 0:
+            await self.finished.wait()
+
+    async def run(self):
+        '''
+        Moves hosts from the heap to the workers once they are
+        eligible again, for as long as the sweep is running.
+        '''
+        loop = asyncio.get_running_loop()
+
+        while True:
+            while len(self.delayed) > 0 and self.delayed[0][0] <= loop.time():
+                self.ready.put_nowait(heapq.heappop(self.delayed)[2])
+
+            # Sleep until the next host is eligible or until a
+            # new retry is scheduled.
+            timeout = self.delayed[0][0] - loop.time() if len(self.delayed) > 0 else None
+            self.wakeup.clear()
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+
+            except asyncio.TimeoutError:
+                pass
+
+class DEVICE_SNAPSHOT():
+    '''
+    Fleet-wide snapshot of the devices' last reported time,
+    keyed by device_id. It is refreshed in bulk from the CB
+    device list every DEVICE_SNAPSHOT_INTERVAL seconds, so
+    checking a host against the minimum check in time does
+    not need an API call per host.
+    '''
+
+    def __init__(self, client, interval):
+        self.client = client
+        self.interval = interval
+        self.devices = dict()
 
-        else:
-            return False
+        # Functions called with the snapshot after every refresh.
+        self.callbacks = list()
+
+        # The device list does not always come with the device
+        # id, so the endpoints collection is used to map the
+        # hostnames back to their device id.
+        self.hostnames = {host['hostname']: host['device_id'] for host in CB_BOT_DB.endpoints.find()}
 
-    def put_file_request(self, session_id, sensor_name, file_id):
+    def get_device_id(self, device):
         '''
-        Puts file on the system.
+        Gets the device id of a device in the device list.
+
+        :param device:
+        :return device_id:
         '''
-        # Extract the filename. Remove all path.
-        file_name = ((self.upload_file).split('/'))[-1]
-        upload_file = 'C:\\Windows\\Temp\\{}'.format(file_name)
 
-        # Variables used for the POST request.
-        request_url = '{}/integrationServices/v3/cblr/session/{}/command'.format(self.CB_ROOT_URL, session_id)
+        if device.get('deviceId'):
+            return int(device['deviceId'])
 
-        header = {'X-Auth-Token': self.CB_XAUTH_TOKEN,
-                  'Content-Type': "application/json"}
+        return self.hostnames.get(device.get('deviceName', device.get('name')))
 
-        body = {"file_id": file_id,
-                "name": "put file",
-                "object": upload_file}
+    def get_device_reported_time(self, device):
+        '''
+        Gets the last reported time of a device in the device
+        list, or False if there is none.
 
-        # Sends POST request to obtain a file
-        response = requests.post(request_url,
-                                 headers=header,
-                                 data=json.dumps(body),
-                                 verify=False,
-                                 timeout=180)
+        :param device:
+        :return last_reported:
+        '''
 
-        # Makes sure we get a successful response.
-        if response.status_code == 200:
-            # Gets the command id.
-            file_upload_id = json.loads((response.content).decode()).get('id')
+        if device.get('lastReportedTime'):
+            return datetime.datetime.utcfromtimestamp((int(device['lastReportedTime'])/1000))
 
-            # Checks status until done.
-            return self.put_file_check(session_id, sensor_name, file_upload_id)
+        # Get the right timestamp format, the same way the
+        # endpoint list refresh does.
+        try:
+            timestamp_str = '{} {}'.format(device.get('lastCheckInDate'), device.get('lastCheckInTime'))
+            return datetime.datetime.strptime(timestamp_str, '%Y%m%d %H%M%S')
 
-        else:
+        # This is just to catch if no timestamps were provided.
+        except:
             return False
 
-    def put_file_check(self, session_id, sensor_name, file_upload_id):
-        '''
-        Checks status of the file for download
+    def get_last_reported_time(self, device_id):
         '''
-        # This counter is to make sure that this does not die.
-        # It should never die, but you never know.
-        count = 0 
-
-        # This is to try a request every 2 seconds for every 5 minutes.
-        while count < self.WAITING_PERIOD:
-            # Sleep for interval in seconds
-            time.sleep(self.SLEEP_INTERVAL)
-
-            # Variables used for the POST request.
-            request_url = '{}/integrationServices/v3/cblr/session/{}/command/{}'.format(self.CB_ROOT_URL, session_id, file_upload_id)
-            header = {'X-Auth-Token': self.CB_XAUTH_TOKEN,
-                      'Content-Type': "application/json"}
-
-            # Sends GET request to obtain command execution status
-            response = requests.get(request_url,
-                                    headers=header,
-                                    verify=False,
-                                    timeout=180)
-
-            # Makes sure we get a successful response
-            if response.status_code == 200:
-                # Checks if the command has completed or not.
-                if json.loads((response.content).decode()).get('status') == "complete":
-                    return True
+        Gets the last reported time of a device. Returns None
+        if the device is not in the snapshot.
 
-            # Keep adding to the counter to exit.
-            count += self.SLEEP_INTERVAL
+        :param device_id:
+        :return last_reported:
+        '''
 
-        # Assuming no live session could be established after 2 minutes
-        return False
+        return self.devices.get(int(device_id))
 
-    def get_file_request(self, session_id, sensor_name):
+    async def refresh(self):
         '''
-        Grabs a file from CB. It needs to execute a
-        command, and check.
+        Rebuilds the snapshot from the CB device list.
         '''
+        request_url = '/integrationServices/v3/device/all'
+        parameters = {'fileFormat': 'json'}
 
-        # Variables used for the POST request.
-        request_url = '{}/integrationServices/v3/cblr/session/{}/command'.format(self.CB_ROOT_URL, session_id)
+        # Sends GET request to collect every device.
+        response = await self.client.get('device_all', request_url,
+                                         params=parameters)
 
-        header = {'X-Auth-Token': self.CB_XAUTH_TOKEN,
-                  'Content-Type': "application/json"}
+        # Checks if the status was successful.
+        if response.status_code == 200:
+            devices = dict()
 
-        body = {"session_id": session_id,
-                    "name": "get file",
-                    "object": self.out_file}
+            for device in json.loads(response.content.decode()).get('results', list()):
+                device_id = self.get_device_id(device)
 
-        # Sends POST request to obtain a file
-        response = requests.post(request_url,
-                                 headers=header,
-                                 data=json.dumps(body),
-                                 verify=False,
-                                 timeout=180)
+                if device_id != None:
+                    devices[int(device_id)] = self.get_device_reported_time(device)
 
-        # Makes sure we get a successful response.
-        if response.status_code == 200:
-            # Gets the command id.
-            command_id = json.loads((response.content).decode()).get('id')
+            self.devices = devices
 
-            # Collects the file_id for download.
-            file_id = self.get_file_check(session_id, sensor_name, command_id)
+    async def run(self):
+        '''
+        Refreshes the snapshot on a timer for as long as the
+        sweep is running.
+        '''
 
-            # If no file_id, then return that there was an error.
-            if file_id == False:
-                return False
+        while True:
+            await asyncio.sleep(self.interval)
 
-            # Otherwise, we have file_id, let's download this puppy.
-            else:
-                file_download_status = self.get_file_download(session_id, sensor_name, file_id)
+            try:
+                await self.refresh()
 
-                if file_download_status == False:
-                    return False
+                for callback in self.callbacks:
+                    callback(self)
 
-            return True
+            except Exception as e:
+                print("Error refreshing the device snapshot: {}".format(e))
 
-        else:
-            return False
+class STATUS_POLLER():
+    '''
+    Polls the status of every pending session, command and
+    file transfer in the sweep from a single place. Hosts ask
+    the poller to watch something and sleep until it changes.
+    Every pending session is checked with one call listing the
+    sessions, and the commands of a session with one call
+    listing its commands, so the number of calls depends on
+    the number of sessions and not on how many hosts are
+    waiting. Calls are kept under POLLER_RATE_LIMIT.
+    '''
+
+    def __init__(self, client, polling_strategy, rate_limit):
+        self.client = client
+        self.polling = polling_strategy
+        self.rate_limit = rate_limit
+        self.tokens = rate_limit
+        self.pending = dict()
+        self.in_flight = set()
+        self.wakeup = asyncio.Event()
 
-    def get_file_check(self, session_id, sensor_name, command_id):
+    def watch(self, phase, session_id, command_id=None):
         '''
-        Checks status of the file for download
+        Starts watching a session or a command. The future is
+        resolved with the CB status once it is done, or with
+        False once the waiting period runs out.
+
+        :param phase:
+        :param session_id:
+        :param command_id:
+        :return future:
         '''
-        # This counter is to make sure that this does not die.
-        # It should never die, but you never know.
-        count = 0 
+        key = (session_id, command_id)
 
-        # This is to try a request every 2 seconds for every 5 minutes.
-        while count < self.WAITING_PERIOD:
-            # Sleep for interval in seconds
-            time.sleep(self.SLEEP_INTERVAL)
+        # Someone is already waiting on it, share the result.
+        if key in self.pending:
+            return self.pending[key]['future']
 
-            # Variables used for the POST request.
-            request_url = '{}/integrationServices/v3/cblr/session/{}/command/{}'.format(self.CB_ROOT_URL, session_id, command_id)
-            header = {'X-Auth-Token': self.CB_XAUTH_TOKEN,
-                      'Content-Type': "application/json"}
+        loop = asyncio.get_running_loop()
+        delays = self.polling.get_delays(phase)
 
-            # Sends GET request to obtain command execution status
-            response = requests.get(request_url,
-                                    headers=header,
-                                    verify=False,
-                                    timeout=180)
+        self.pending[key] = {'phase': phase,
+                             'future': loop.create_future(),
+                             'delays': delays,
+                             'due': loop.time() + next(delays)}
 
-            # Makes sure we get a successful response
-            if response.status_code == 200:
-                # Checks if the command has completed or not.
-                if json.loads((response.content).decode()).get('status') == "complete":
-                    return json.loads((response.content).decode()).get('file_id')
+        # Lets the poller know there is something new to track.
+        self.wakeup.set()
 
-            # Keep adding to the counter to exit.
-            count += self.SLEEP_INTERVAL
+        return self.pending[key]['future']
 
-        # Assuming no live session could be established after 2 minutes
-        return False
+    def finish(self, key, results):
+        '''
+        Stops watching something and wakes up its host.
 
-    def get_file_download(self, session_id, sensor_name, file_id):
+        :param key:
+        :param results:
         '''
-        Downloads file to directory
+        entry = self.pending.pop(key)
+
+        if not entry['future'].done():
+            entry['future'].set_result(results)
+
+    def get_group(self, key):
         '''
-        # Checks if directory exists before dumping to folder.
-        output_folder = "{}/{}_{}".format(OUTPUT_DIRECTORY, self.TUID, (self.sweep_name).replace(' ', '_'))
-        hunt_file_stripped = ((self.out_file).split('\\')[-1]).replace(' ', '_')
-        output_filename = "{}_{}".format(sensor_name, hunt_file_stripped)
-        output_file_path = "{}/{}".format(output_folder, output_filename)
+        Gets the status call that covers something being watched.
+        Every session is covered by the session list, and every
+        command of a session by the command list of the session.
 
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
+        :param key:
+        :return group:
+        '''
 
-        # Variables used for the POST request.
-        request_url = '{}/integrationServices/v3/cblr/session/{}/file/{}/content'.format(self.CB_ROOT_URL, session_id, file_id)
+        if self.pending[key]['phase'] == 'session':
+            return ('session', None)
 
-        header = {'X-Auth-Token': self.CB_XAUTH_TOKEN,
-                  'Content-Type': "application/json"}
+        return ('command', key[0])
 
-        # Sends POST request to obtain a file
-        response = requests.get(request_url,
-                                headers=header,
-                                verify=False,
-                                timeout=180)
+    async def get_statuses(self, group):
+        '''
+        Lists the status of every session, or of every command
+        of one session, with a single call to CB.
 
-        if response.status_code == 200:
-            # Saves file to directory.
-            with open(output_file_path, "wb") as ofile:
-                # Write file to disk.
-                ofile.write(response.content)
+        :param group:
+        :return statuses: dictionary of id: status entry, or None
+                          if the list could not be read.
+        '''
+        phase, session_id = group
 
-            return True
+        # Variables used for the GET request.
+        if phase == 'session':
+            request_url = '/integrationServices/v3/cblr/session'
 
         else:
-            return False
+            request_url = '/integrationServices/v3/cblr/session/{}/command'.format(session_id)
 
-    def get_sweep_log_host_id(self, device_id):
-        '''
-        Gets the host information for one host host in the
-        sweep_log from the MongoDB database.
-        '''
-        # Queries Mongo for the host in the sweep_log.
-        return CB_BOT_DB.sweep_log.find_one({"device_id": int(device_id), "tuid": int(self.TUID)})['_id']
+        response = await self.client.get(phase, request_url)
 
-    def update_one_host_sweep(self, data_type, data_value, _id):
+        # Check if it was a valid response.
+        if response.status_code != 200:
+            return None
+
+        results = json.loads((response.content).decode())
+
+        # Some versions wrap the list in 'results'.
+        if type(results) is dict:
+            results = results.get('results', [])
+
+        return {str(item.get('id')): item for item in results}
+
+    async def get_command(self, session_id, command_id):
         '''
-        Updated a field for a host in the sweep_log collection.
+        Gets everything CB returned for a finished command. The
+        command list only carries the status of the commands,
+        not their results.
 
-        :param data_type:
-        :param data_value:
-        :param _id:
+        :param session_id:
+        :param command_id:
+        :return results:
         '''
+        request_url = '/integrationServices/v3/cblr/session/{}/command/{}'.format(session_id, command_id)
+        response = await self.client.get('command', request_url)
 
-        # Updates the record for a host in the sweep_log collection.
-        CB_BOT_DB.sweep_log.update_one({'_id': _id},
-                                     {'$set': {data_type: data_value}},
-                                     upsert=False)
+        if response.status_code == 200:
+            return json.loads((response.content).decode())
+
+        return None
 
-    def get_host_last_reported_time(self, sensor_id):
+    async def poll(self, group, dispatched):
         '''
-        This queries the CB API for the host's last reported
-        timestamp. Once we have that we can cross check the
-        minimum checking time selected.
+        Checks the status of every session, or of every command
+        of one session, and wakes up the hosts whose session or
+        command is done. The ones that were due and are still
+        pending get their next check scheduled.
+
+        :param group:
+        :param dispatched: loop time the check was sent at.
         '''
+        phase, session_id = group
+        keys = [key for key in self.pending if self.get_group(key) == group]
+        statuses = None
 
-        # Variables used for the GET request.
-        request_url = '{}/integrationServices/v3/device/{}'.format(self.CB_ROOT_URL, sensor_id)
-        header = {'X-Auth-Token': self.CB_XAUTH_TOKEN}
+        try:
+            # A single command is checked directly, since that
+            # also gets its results.
+            if phase == 'command' and len(keys) == 1:
+                results = await self.get_command(session_id, keys[0][1])
+                statuses = {str(keys[0][1]): results} if results != None else None
 
-        # Sends GET request to check on a CB Session
-        response = requests.get(request_url,
-                                headers=header,
-                                verify=False,
-                                timeout=180)
+            else:
+                statuses = await self.get_statuses(group)
 
-        # Check if it was a valid response.
-        if response.status_code == 200:
-            # This is to check if the sensor is listed. Most likely yes.
-            results = json.loads((response.content).decode())
+            for key in keys:
+                status = (statuses or {}).get(str(key[0] if phase == 'session' else key[1]))
 
-            # Confirms if there is an active LR Session or not.
-            # If it says PENDING, we should wait for a session
-            # ID to spin up. 
-            if results.get('success') == True:
-                return datetime.datetime.utcfromtimestamp((int(results['deviceInfo']['lastReportedTime'])/1000))
+                if status == None:
+                    continue
 
-            else:
-                return False
+                # Sessions are done once they are 'ACTIVE', and are
+                # gone if they are closed or errored out.
+                if phase == 'session':
+                    if status.get('status') == "ACTIVE":
+                        self.finish(key, status)
 
-    def update_completed_hosts_task(self):
-        '''
-        Updates the count of hosts that have been completed
-        on a particular sweep.
-        '''
-        # Check on completed host count
-        completed_count = len(list(CB_BOT_DB.sweep_log.find({"tuid": int(self.TUID), "complete": True})))
+                    elif status.get('status') in ("CLOSE", "ERROR"):
+                        self.finish(key, False)
 
-        # Change the completed_hosts count on the specific task.
-        update_task('completed_hosts', completed_count, self.task_object_id)
+                # Commands and file transfers are done once they
+                # complete or error out.
+                elif status.get('status') in ("complete", "error"):
+                    results = status if len(keys) == 1 else await self.get_command(session_id, key[1])
+
+                    if results != None:
+                        self.finish(key, results)
+
+        except Exception as e:
+            print("Error polling {}: {}".format(group, e))
+
+        finally:
+            self.in_flight.discard(group)
+
+        # Schedules the next check of what was due, or gives up
+        # once the waiting period has run out.
+        for key in keys:
+            entry = self.pending.get(key)
+
+            if entry == None or entry['due'] > dispatched:
+                continue
+
+            try:
+                entry['due'] = asyncio.get_running_loop().time() + next(entry['delays'])
+
+            except StopIteration:
+                self.finish(key, False)
 
-    def delete_file(self, session_id, sensor_name, file_to_delete):
+        self.wakeup.set()
+
+    async def run(self):
         '''
-        Deletes the file created on disk.
+        Polls whatever is due, oldest first, for as long as
+        the sweep is running. Everything due in the same group
+        is checked with one call, and calls are paced with a
+        token bucket refilled at 'rate_limit' tokens per second.
         '''
-        # # Debug Log
-        # print("[RUNNING] Grabbing output file on %s" % (sensor_name))
+        loop = asyncio.get_running_loop()
+        last_refill = loop.time()
 
-        # Variables used for the POST request.
-        request_url = '{}/integrationServices/v3/cblr/session/{}/command'.format(self.CB_ROOT_URL, session_id)
+        while True:
+            # Refill the token bucket.
+            now = loop.time()
+            self.tokens = min(self.rate_limit, self.tokens + (now - last_refill) * self.rate_limit)
+            last_refill = now
 
-        header = {'X-Auth-Token': self.CB_XAUTH_TOKEN,
-                  'Content-Type': "application/json"}
+            # Every group with something due that is not being
+            # checked already, with its oldest due time.
+            groups = dict()
 
-        body = {"session_id": session_id,
-                "name": "delete file",
-                "object": file_to_delete}
+            for key, entry in self.pending.items():
+                group = self.get_group(key)
 
-        # Sends POST request to obtain a file
-        response = requests.post(request_url,
-                                 headers=header,
-                                 data=json.dumps(body),
-                                 verify=False,
-                                 timeout=180)
+                if entry['due'] <= now and group not in self.in_flight:
+                    groups[group] = min(entry['due'], groups.get(group, entry['due']))
 
-        # Makes sure we get a successful response.
-        if response.status_code == 200:
-            # print("[DONE] File deleted on %s" % (sensor_name))
-            return
+            due = sorted((due_time, group) for group, due_time in groups.items())
+            batch = due[:int(self.tokens)]
 
-        else:
-            # print("[ERROR] Error encountered deleting '%s' from %s" % (output_file, sensor_name))
-            # ERROR_HOSTS.append({sensor_name:session_id.split(':')[1]})
-            return
+            for due_time, group in batch:
+                self.tokens -= 1
+                self.in_flight.add(group)
+                asyncio.ensure_future(self.poll(group, now))
+
+            # Sleep until there are tokens for the rest, until the
+            # next check is due, or until something new is watched.
+            if len(due) > len(batch):
+                timeout = 1 / self.rate_limit
+
+            else:
+                upcoming = [entry['due'] for key, entry in self.pending.items() if self.get_group(key) not in self.in_flight]
+                timeout = max(0, min(upcoming) - loop.time()) if len(upcoming) > 0 else None
+
+            self.wakeup.clear()
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+
+            except asyncio.TimeoutError:
+                pass
 
 def add_hosts_to_sweep_log(host_list, device_type):
     '''
@@ -891,6 +3202,71 @@ def add_hosts_to_sweep_log(host_list, device_type):
     # Return the sweep_host_List
     return sweep_host_list
 
+def get_local_hash(file_path):
+    '''
+    Gets the SHA256 and size of a file on disk, or None if
+    the file is not there.
+
+    :param file_path:
+    :return results: (sha256, size)
+    '''
+
+    if not os.path.exists(file_path):
+        return None
+
+    sha256 = hashlib.sha256()
+    size = 0
+
+    with open(file_path, "rb") as lfile:
+        for chunk in iter(lambda: lfile.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            size += len(chunk)
+
+    return (sha256.hexdigest(), size)
+
+def join_chunks(chunk_paths, output_file_path):
+    '''
+    Writes the chunks of a file, in order, to the output file
+    and hashes it on the way.
+
+    :param chunk_paths:
+    :param output_file_path:
+    :return sha256:
+    '''
+    sha256 = hashlib.sha256()
+
+    with open(output_file_path, "wb") as ofile:
+        for chunk_path in chunk_paths:
+            with open(chunk_path, "rb") as cfile:
+                for chunk in iter(lambda: cfile.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    ofile.write(chunk)
+                    sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+def get_hash_command(file_path, output_file):
+    '''
+    Gets the PowerShell command that writes the SHA256, MD5
+    and size of a file to the output file, or 'missing' if
+    the file is not there.
+
+    :param file_path:
+    :param output_file:
+    :return command:
+    '''
+
+    # Single quotes are escaped by doubling them in PowerShell.
+    file_path = file_path.replace("'", "''")
+    output_file = output_file.replace("'", "''")
+
+    return ('powershell.exe -NoProfile -Command "'
+            '$p = \'{}\'; $o = \'{}\'; '
+            'if (Test-Path -LiteralPath $p -PathType Leaf) {{ '
+            '$s = Get-FileHash -Algorithm SHA256 -LiteralPath $p; '
+            '$m = Get-FileHash -Algorithm MD5 -LiteralPath $p; '
+            '$s.Hash + \',\' + $m.Hash + \',\' + (Get-Item -LiteralPath $p).Length | Out-File -Encoding ascii $o '
+            '}} else {{ \'missing\' | Out-File -Encoding ascii $o }}"').format(file_path, output_file)
+
 def get_command_specs():
     '''
     Gets the command specifications given the proper command id.
@@ -900,6 +3276,25 @@ def get_command_specs():
 
     return CB_BOT_DB.sweep_commands.find_one({"cuid": {"$eq": CUID}})
 
+def get_steps_error(steps):
+    '''
+    Checks the steps of a pipeline sweep before it starts.
+    The 'put' steps need the file to upload and the path
+    to upload it to.
+
+    :param steps:
+    :return error: None if the steps are valid.
+    '''
+
+    for index, step in enumerate(steps):
+        if step.get('action') not in ('put', 'execute', 'get', 'delete', 'list'):
+            return "Step {} has an unknown action.".format(index + 1)
+
+        if step['action'] == 'put' and not (step.get('file') and step.get('path')):
+            return "Step {} (put) needs a 'file' and a 'path'.".format(index + 1)
+
+    return None
+
 def get_hosts_to_sweep(device_type):
     '''
     Checks if the sweep has already existed and systems have been
@@ -937,12 +3332,15 @@ def get_hosts_to_sweep(device_type):
     # in this sweep run/task.
     return sweep_host_list
 
-def start_queue(host_list, command_specs, _id, sweep_name):
+async def start_queue(host_list, command_specs, _id, sweep_name):
     '''
-    Starts a multi-threaded queue using all of
-    the sensors in the sensor list. This way you
-    can call up the process to run your action
-    in CB.
+    Starts an asyncio queue using all of the sensors in
+    the sensor list and runs them through the sweep
+    pipeline. Every stage shares a single HTTP client, so
+    the number of hosts in flight is only bound by the CB
+    session limit.
+
+    :return success:
     '''
     # Update the MongoDB details for the task
     total_hosts = get_sweep_log_host_count()
@@ -950,7 +3348,7 @@ def start_queue(host_list, command_specs, _id, sweep_name):
 
     # Create a master dictionary to return.
     # Defines the queue
-    queue_list = queue.Queue()
+    queue_list = RETRY_QUEUE(MAX_ATTEMPTS, RETRY_BACKOFF)
 
     try:
         # Add each of the sensors to the queue
@@ -959,30 +3357,119 @@ def start_queue(host_list, command_specs, _id, sweep_name):
 
             for sensor_name, sensor_id in obj.items():
                 item = '{}||{}'.format(sensor_name, sensor_id)
-                queue_list.put(item)
+                queue_list.put_nowait(item)
 
         # If no sensors in list, return
-        if queue.Queue.qsize(queue_list) == 0:
-            return
+        if queue_list.qsize() == 0:
+            return True
+
+        total_hosts = queue_list.qsize()
+
+        # Every worker shares the same connection pool, which is
+        # sized to the number of sessions that can be open.
+        async with cb_client.CB_ASYNC_CLIENT(CB_ROOT_URL,
+                                             CB_XAUTH_TOKEN,
+                                             CB_CONCURRENT_SESSIONS,
+                                             http2=CB_HTTP2) as client:
+            # One status poller is shared by every worker.
+            polling_strategy = polling.get_polling_strategy(POLLING_STRATEGY, WAITING_PERIOD, SLEEP_INTERVAL)
+            poller = STATUS_POLLER(client, polling_strategy, POLLER_RATE_LIMIT)
+            poller_task = asyncio.ensure_future(poller.run())
+
+            # The device snapshot is built before the first host is
+            # checked, then refreshed in the background.
+            snapshot = DEVICE_SNAPSHOT(client, DEVICE_SNAPSHOT_INTERVAL)
+
+            try:
+                await snapshot.refresh()
+
+            except Exception as e:
+                print("Error building the device snapshot: {}".format(e))
+
+            snapshot_task = asyncio.ensure_future(snapshot.run())
+
+            # Runs the pipeline until every host is done, or until
+            # the workers have errored out.
+            cb_bot = CB_BOT(client, poller, snapshot, queue_list, total_hosts, command_specs, _id, sweep_name)
+
+            # Hands failed hosts back to the workers once they are
+            # eligible again, and parked hosts once they check in.
+            retry_task = asyncio.ensure_future(queue_list.run())
+            snapshot.callbacks.append(cb_bot.wake_hosts)
 
-        # print("Queue size: {}".format(queue.Queue.qsize(queue_list)))
-        # quit()
+            success = await cb_bot.run_sweep()
 
-        workers_list = []
-        total_hosts = queue.Queue.qsize(queue_list)
+            # Nothing is left to poll, refresh or retry.
+            poller_task.cancel()
+            snapshot_task.cancel()
+            retry_task.cancel()
 
-        for i in range(CB_CONCURRENT_SESSIONS):
-            # Start multi-threading and run "run_cb_gather" function
-            # to start running the query that we want it to do.
-            cb_bot_worker = CB_BOT(queue_list, total_hosts, command_specs, _id, sweep_name)
-            worker = threading.Thread(target=cb_bot_worker.run_sweep, daemon=True)
-            worker.start()
-            workers_list.append(worker)
-        queue_list.join()
+        return success
 
+    # A sweep that dies is failed like one whose workers
+    # errored out, so its sessions get reaped too.
     except Exception as e:
         print("Error at 'start_queue' function: {}".format(e))
 
+    return False
+
+async def start_search(host_list, command_specs, _id):
+    '''
+    Runs a search sweep. The query runs once against the CB
+    search API instead of opening a CB session on every host,
+    so offline hosts do not matter. The hits are then matched
+    to the hosts of the sweep log.
+
+    :return success:
+    '''
+    # Update the MongoDB details for the task
+    total_hosts = get_sweep_log_host_count()
+    update_task('total_hosts', total_hosts, _id)
+
+    device_ids = [int(sensor_id) for obj in host_list for sensor_id in dict(obj).values()]
+
+    async with cb_client.CB_ASYNC_CLIENT(CB_ROOT_URL,
+                                         CB_XAUTH_TOKEN,
+                                         CB_CONCURRENT_SESSIONS,
+                                         http2=CB_HTTP2) as client:
+        search_bot = search.SEARCH_BOT(client,
+                                       command_specs.get('search_type', 'process'),
+                                       INPUT_FILE,
+                                       CB_CONCURRENT_SESSIONS,
+                                       SEARCH_PAGE_SIZE,
+                                       SEARCH_MAX_RESULTS,
+                                       SEARCH_WINDOW)
+        results = await search_bot.search()
+
+    if results == False:
+        return False
+
+    # Hosts without hits in a truncated search may still have
+    # some, so the task records that not every result was read.
+    update_task('search_total_results', search_bot.total, _id)
+    update_task('search_truncated', search_bot.truncated, _id)
+
+    if search_bot.truncated:
+        print("[TASK ID: {}] Search has {} results, only the first {} were read.".format(TUID, search_bot.total, SEARCH_MAX_RESULTS))
+
+    # Updates every host of the sweep in one go.
+    timestamp = datetime.datetime.utcnow()
+    updates = list()
+
+    for device_id, fields in search.group_hits(results, device_ids, SEARCH_HITS_PER_HOST, search_bot.truncated).items():
+        fields['complete'] = True
+        fields['completed_timestamp'] = timestamp
+
+        updates.append(pymongo.UpdateOne({'tuid': int(TUID), 'device_id': device_id},
+                                          {'$set': fields}))
+
+    if updates:
+        CB_BOT_DB.sweep_log.bulk_write(updates, ordered=False)
+
+    update_task('completed_hosts', CB_BOT_DB.sweep_log.count_documents({"tuid": int(TUID), "complete": True}), _id)
+
+    return True
+
 def get_sweep_log_host_count():
     '''
     Get host count on all of the hosts for a
@@ -1048,6 +3535,62 @@ def get_largest_auid():
 
     return user_list[0]['auid']
 
+def get_largest_tuid():
+    '''
+    Gets the largest TUID for the tasks in the database.
+
+    :return tuid:
+    '''
+
+    # Queries the MongoDB database for the largest TUID.
+    task_list = list(CB_BOT_DB.task_history.find({}).sort('tuid', pymongo.DESCENDING).limit(1))
+
+    # Checks if there are no TUIDs.
+    if len(task_list) == 0:
+        return 0
+
+    return task_list[0]['tuid']
+
+def start_session_reaper():
+    '''
+    Starts a job that closes the CB sessions no running
+    sweep owns anymore, so the sessions a failed sweep
+    left open do not starve the next sweep.
+
+    :return tuid:
+    '''
+    sweep_task = get_task_object_id()
+
+    task = dict()
+
+    task['name'] = 'Reap Orphaned Sessions'
+    task['task'] = 'job'
+    task['type'] = 'Reap Orphaned Sessions'
+    task['owner'] = sweep_task['owner']
+    task['uuid'] = sweep_task.get('uuid')
+    task['cuid'] = 0
+    task['tuid'] = get_largest_tuid() + 1
+    task['created'] = datetime.datetime.utcnow()
+    task['expiration'] = task['created'] + datetime.timedelta(days=7)
+    task['total_hosts'] = 0
+    task['completed_hosts'] = 0
+    task['active'] = True
+
+    # Adds the task to the collection before the script
+    # looks it up.
+    CB_BOT_DB.task_history.insert_one(task)
+
+    # The reaper lives next to this script.
+    script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'session_reaper.py')
+
+    # Runs a subprocess
+    process = subprocess.Popen(['python3', script_path, str(task['tuid'])], shell=False)
+
+    # Assign the process id to the task object.
+    update_task('pid', process.pid, task['_id'])
+
+    return task['tuid']
+
 def main():
     '''
     Main function for cb_bot.
@@ -1060,6 +3603,33 @@ def main():
     _id = get_task_object_id()["_id"]
     sweep_name = get_task_object_id()["name"]
 
+    # Pipeline sweeps with invalid steps are failed before any
+    # host is swept.
+    if command_specs['command_type'] == 9:
+        steps_error = get_steps_error(command_specs.get('steps', []))
+
+        if steps_error != None:
+            print("[!] {}".format(steps_error))
+
+            # Create an alert.
+            alert = dict()
+            auid = get_largest_auid() + 1
+            timestamp = datetime.datetime.utcnow()
+            alert['created'] = timestamp
+            alert['message_date'] = timestamp.strftime("%B %d, %Y  %-I:%M %p UTC")
+            alert['active'] = True
+            alert['owner'] = get_task_owner()
+            alert['auid'] = auid
+            alert['message'] = "Failed Sweep with Task ID {}: {}. {}".format(TUID, sweep_name, steps_error)
+
+            # Tell Mongo to add alert.
+            create_alert(alert)
+
+            # Change Task status to inactive and terminate the program.
+            update_task('active', False, _id)
+
+            quit()
+
     # Check if we are restarting the script on the remaining
     # hosts or if we haven't created anything at all.
     host_list = get_hosts_to_sweep(command_specs['device_type'])
@@ -1091,8 +3661,40 @@ def main():
     # print("Running sweep on {} hosts.".format(len(host_list)))
     # # ========= DEV =========
 
-    # Initiates the multi-threading process.
-    start_queue(host_list, command_specs, _id, sweep_name)
+    # Search sweeps do not need a CB session on the hosts.
+    if command_specs['command_type'] == 8:
+        success = asyncio.run(start_search(host_list, command_specs, _id))
+
+    # Initiates the asyncio sweep engine.
+    else:
+        success = asyncio.run(start_queue(host_list, command_specs, _id, sweep_name))
+
+    # The workers errored out, so the sweep is failed instead
+    # of being completed.
+    if success == False:
+        # Create an alert.
+        alert = dict()
+        auid = get_largest_auid() + 1
+        timestamp = datetime.datetime.utcnow()
+        alert['created'] = timestamp
+        alert['message_date'] = timestamp.strftime("%B %d, %Y  %-I:%M %p UTC")
+        alert['active'] = True
+        alert['owner'] = get_task_owner()
+        alert['auid'] = auid
+        alert['message'] = "Failed Sweep with Task ID {}: {}. cb_bot workers errored out.".format(TUID, sweep_name)
+
+        # Tell Mongo to add alert.
+        create_alert(alert)
+
+        # Updated the task.
+        update_task('active', False, _id)
+
+        # The task is inactive now, so the reaper closes the
+        # sessions this sweep left open.
+        if command_specs['command_type'] != 8:
+            start_session_reaper()
+
+        quit()
 
     # Add template for initial alert. Then we will need to change
     # this to True.
@@ -5,9 +5,8 @@ import sys
 import threading
 
 import pymongo
-import requests
 
-requests.packages.urllib3.disable_warnings()
+import cb_client
 
 # Database configuration
 MONGO_CLIENT = pymongo.MongoClient('127.0.0.1', 5051)
@@ -15,14 +14,13 @@ CB_BOT_DB = MONGO_CLIENT.cb_bot
 
 class CB_BOT():
 
-    def __init__(self, queue_list, total_hosts, _id, auid, CB_ROOT_URL, CB_XAUTH_TOKEN):
+    def __init__(self, client, queue_list, total_hosts, _id, auid):
+        self.client = client
         self.queue_list = queue_list
         self.sensor_data = dict()
         self.total_hosts = total_hosts
         self._id = _id
         self.auid = auid
-        self.CB_ROOT_URL = CB_ROOT_URL
-        self.CB_XAUTH_TOKEN = CB_XAUTH_TOKEN
 
     def add_one_host(self, sensor):
         '''
@@ -95,16 +93,12 @@ class CB_BOT():
         ''' 
 
         try:
-            request_url = '{}/integrationServices/v3/device'.format(self.CB_ROOT_URL)
-            header = {'X-Auth-Token': self.CB_XAUTH_TOKEN}
+            request_url = '/integrationServices/v3/device'
             parameters = {'hostNameExact': hostname}
 
             # Sends GET request to collect host information
-            response = requests.get(request_url,
-                                    headers=header,
-                                    params=parameters,
-                                    verify=False,
-                                    timeout=180)
+            response = self.client.get('device', request_url,
+                                       params=parameters)
 
             # Checks if the status was successful.
             if response.status_code == 200:
@@ -248,22 +242,18 @@ class CB_BOT():
                                         {'$set': {data_type: data_value}},
                                         upsert=False)
 
-def get_all_sensors(CS_CONCURRENT_SESSIONS, CB_ROOT_URL, CB_XAUTH_TOKEN, _id, auid):
+def get_all_sensors(client, CS_CONCURRENT_SESSIONS, _id, auid):
     '''
     Gets a list of all the sensors/computers registered to 
     the specific account. and returns a list with all of
     the necessary elements for our tool.
     '''
-    request_url = '{}/integrationServices/v3/device/all'.format(CB_ROOT_URL)
-    header = {'X-Auth-Token': CB_XAUTH_TOKEN}
+    request_url = '/integrationServices/v3/device/all'
     parameters = {'fileFormat': 'json'}
 
     # Sends GET request to collect host names
-    response = requests.get(request_url,
-                            headers=header,
-                            params=parameters,
-                            verify=False,
-                            timeout=180)
+    response = client.get('device_all', request_url,
+                          params=parameters)
 
     # Checks if the status was successful.
     if response.status_code == 200:
@@ -296,7 +286,7 @@ def get_all_sensors(CS_CONCURRENT_SESSIONS, CB_ROOT_URL, CB_XAUTH_TOKEN, _id, au
             for i in range(int(CS_CONCURRENT_SESSIONS)):
                 # Start multi-threading and run "run_cb_gather" function
                 # to start running the query that we want it to do.
-                cb_bot_worker = CB_BOT(queue_list, total_hosts, _id, auid, CB_ROOT_URL, CB_XAUTH_TOKEN)
+                cb_bot_worker = CB_BOT(client, queue_list, total_hosts, _id, auid)
                 worker = threading.Thread(target=cb_bot_worker.start_updating, daemon=True)
                 worker.start()
                 workers_list.append(worker)
@@ -404,6 +394,7 @@ def main():
         CB_API_ID = config['api_id']
         CB_XAUTH_TOKEN = '{}/{}'.format(CB_API_SECRET_KEY, CB_API_ID)
         CS_CONCURRENT_SESSIONS = config['max_sessions']
+        CB_HTTP2 = str(config.get('http2', 'false')).lower() == 'true'
 
     # Get the _id from the task, given the TUID.
     tuid = sys.argv[1]
@@ -424,8 +415,10 @@ def main():
     # Tell Mongo to add alert.
     create_alert(alert)
     
-    # Collect all of the sensors and their device IDs.
-    get_all_sensors(CS_CONCURRENT_SESSIONS, CB_ROOT_URL, CB_XAUTH_TOKEN, _id, auid)
+    # Collect all of the sensors and their device IDs. Every
+    # worker shares the same pooled CB client.
+    with cb_client.CB_CLIENT(CB_ROOT_URL, CB_XAUTH_TOKEN, CS_CONCURRENT_SESSIONS, http2=CB_HTTP2) as client:
+        get_all_sensors(client, CS_CONCURRENT_SESSIONS, _id, auid)
 
     # Change Task status to inactive and terminate the program.
     update_task('active', False, _id)
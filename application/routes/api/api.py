@@ -359,6 +359,11 @@ def stop_task(tuid):
     # Update the data in the task.
     mongo.update_task('active', False, task_object['_id'])
 
+    # A killed sweep never gets to close its sessions, so the
+    # reaper closes them before they starve the next sweep.
+    if task_object['active'] and task_object.get('task') == 'sweep':
+        main.start_session_reaper(session['email'], session['id'])
+
     # Records log entry.
     main.record_log(request.path,
                     request.remote_addr,
@@ -398,7 +403,7 @@ def restart_task(tuid):
     
     # This section is to take in the inputs that are not
     # required.
-    if command_type == 3:
+    if command_type in (3, 4, 5, 8):
         # Runs a subprocess
         process = subprocess.Popen(['python3',
                                     script_path,
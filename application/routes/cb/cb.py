@@ -63,10 +63,18 @@ def build_sweep():
         sweep['device_type'] = request.form['input_device_type']
         sweep['modified'] = datetime.datetime.utcnow()
         sweep['name'] = request.form['input_name'].strip().title()
-        sweep['output_file'] = request.form['input_output_file'].strip()
+        sweep['output_file'] = request.form.get('input_output_file', '').strip()
         sweep['owner'] = session['email']
         sweep['require_file'] = False
         sweep['require_input'] = False
+        sweep['compress'] = 'input_compress' in request.form
+        sweep['store_compressed'] = 'input_store_compressed' in request.form
+
+        # Registry sweeps read keys and values instead of
+        # running a command.
+        if 'input_registry' in request.form:
+            sweep['command_type'] = 7
+            sweep['output_file'] = ''
 
         # Add record to the database.
         mongo.add_sweep(sweep)
@@ -140,6 +148,7 @@ def run_sweep():
         sweep['tuid'] = mongo.get_largest_tuid() + 1
         sweep['created'] = datetime.datetime.utcnow()
         sweep['expiration'] = sweep['created'] + datetime.timedelta(days=7)
+        sweep['standing'] = 'input_standing' in request.form
         sweep['total_hosts'] = 0
         sweep['completed_hosts'] = 0
         sweep['active'] = True
@@ -154,8 +163,11 @@ def run_sweep():
 
         # This section is to take in the inputs that are not
         # required.
-        if command_type == 3:
+        if command_type in (3, 4, 5, 8):
             sweep['file_name'] = (request.form['input_file_name']).strip()
+
+            # Hashes of the file worth collecting, for hash sweeps.
+            sweep['target_hashes'] = (request.form.get('input_target_hashes', '')).replace(',', ' ').split()
             # Runs a subprocess
             process = subprocess.Popen(['python3',
                                         script_path,
@@ -264,6 +264,24 @@ def refresh_host_list():
     # Returns the CB Run template.
     return redirect(url_for('endpoints'))
 
+@app.route('/reap_sessions', methods=['GET', 'POST'])
+@fresh_login_required
+def reap_sessions():
+    '''
+    This function will close the CB sessions that were left
+    open by sweeps that were stopped or died.
+    '''
+    # Starts the session reaper job.
+    tuid = start_session_reaper(session['email'], session['id'])
+
+    # Records log entry.
+    record_log(request.path,
+               request.remote_addr,
+               'Created job: "Reap Orphaned Sessions" with Task ID: {}.'.format(tuid))
+
+    # Returns the Tasks template.
+    return redirect(url_for('tasks'))
+
 @app.route('/settings', methods=['GET', 'POST'])
 @fresh_login_required
 def settings():
@@ -602,6 +620,45 @@ def generate_logs_csv(data):
     # Return the path of the log file.
     return output_log_file_path
 
+def start_session_reaper(owner, uuid):
+    '''
+    Starts a job that closes the CB sessions no running
+    sweep owns anymore.
+
+    :param owner:
+    :param uuid:
+    :return tuid:
+    '''
+    task = dict()
+
+    task['name'] = 'Reap Orphaned Sessions'
+    task['task'] = 'job'
+    task['type'] = 'Reap Orphaned Sessions'
+    task['owner'] = owner
+    task['uuid'] = uuid
+    task['cuid'] = 0
+    task['tuid'] = mongo.get_largest_tuid() + 1
+    task['created'] = datetime.datetime.utcnow()
+    task['expiration'] = task['created'] + datetime.timedelta(days=7)
+    task['total_hosts'] = 0
+    task['completed_hosts'] = 0
+    task['active'] = True
+
+    # Tell MongoDB to add task to the collection before
+    # the script looks it up.
+    mongo.add_task(task)
+
+    # Get the path to the 'session_reaper.py' script
+    script_path = '{}/session_reaper.py'.format(app.config['LIBRARIES_DIRECTORY'])
+
+    # Runs a subprocess
+    process = subprocess.Popen(['python3', script_path, str(task['tuid'])], shell=False)
+
+    # Assign the process id to the task object.
+    mongo.update_task('pid', process.pid, task['_id'])
+
+    return task['tuid']
+
 def delete_folder_contents(path):
     '''
     This function deletes all the files in a folder,
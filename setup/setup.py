@@ -91,7 +91,26 @@ def apply_generic_server_settings():
         "api_secret_key" : "",
         "api_id" : "",
         "max_sessions" : "30",
-        "min_check_in_time" : "3"
+        "min_check_in_time" : "3",
+        "http2" : "false",
+        "polling_strategy" : "backoff",
+        "poller_rate_limit" : "20",
+        "session_prefetch" : "5",
+        "session_lease_timeout" : "120",
+        "session_idle_window" : "60",
+        "device_snapshot_interval" : "300",
+        "max_attempts" : "10",
+        "download_chunk_size" : "1048576",
+        "download_retries" : "3",
+        "file_fetch_concurrency" : "4",
+        "large_file_threshold" : "104857600",
+        "file_chunk_size" : "33554432",
+        "chunk_concurrency" : "4",
+        "tool_cache" : "false",
+        "search_page_size" : "1000",
+        "search_max_results" : "10000",
+        "search_window" : "2w",
+        "search_hits_per_host" : "100"
     }
 
     print("[*]\n[*] Added Carbon Black (CB) config! Please make")
@@ -240,7 +259,7 @@ def create_collections():
     print("[*] ------------------------")
     print("[*] Creating collections in 'cb_bot' database...")
 
-    collection_list = ['activity_logs', 'alerts', 'endpoints', 'server_settings', 'sweep_commands', 'sweep_log', 'task_history', 'users']
+    collection_list = ['activity_logs', 'alerts', 'directory_listings', 'endpoints', 'file_chunks', 'lr_sessions', 'process_lists', 'registry_values', 'server_settings', 'staged_payloads', 'sweep_commands', 'sweep_log', 'task_history', 'users']
 
     # Creatie all of the collections.
     for collection in collection_list:
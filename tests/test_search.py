@@ -0,0 +1,100 @@
+import asyncio
+
+import httpx
+
+import cb_client
+import search
+
+
+def get_mock_search_api(total, failing_start=None):
+    '''
+    Gets a mock of the CB process search API with 'total'
+    results, spread over devices 1 to 3, and the list its
+    requests are recorded in.
+
+    :param total:
+    :param failing_start: page that answers with an error.
+    :return transport, requests:
+    '''
+    results = [{'deviceId': (i % 3) + 1, 'processName': 'p{}.exe'.format(i)} for i in range(total)]
+    requests = list()
+
+    def handler(request):
+        start = int(request.url.params['start'])
+        rows = int(request.url.params['rows'])
+        requests.append(request)
+
+        if start == failing_start:
+            return httpx.Response(500)
+
+        return httpx.Response(200, json={'success': True,
+                                         'totalResults': total,
+                                         'results': results[start:start + rows]})
+
+    return httpx.MockTransport(handler), requests
+
+def run_search(transport, page_size, max_results):
+    '''
+    Runs a process search against the mock API.
+
+    :return search_bot, results:
+    '''
+
+    async def run():
+        async with cb_client.CB_ASYNC_CLIENT('https://api.cb.local', 'key/id', 5, transport=transport) as client:
+            search_bot = search.SEARCH_BOT(client, 'process', 'processName:p*', 5, page_size, max_results)
+            return search_bot, await search_bot.search()
+
+    return asyncio.run(run())
+
+def test_search_reads_every_page_and_merges_them():
+    transport, requests = get_mock_search_api(25)
+
+    search_bot, results = run_search(transport, 10, 100)
+
+    assert sorted(int(request.url.params['start']) for request in requests) == [0, 10, 20]
+    assert [result['processName'] for result in results] == ['p{}.exe'.format(i) for i in range(25)]
+    assert requests[0].url.path == '/integrationServices/v3/process'
+    assert requests[0].url.params['query'] == 'processName:p*'
+    assert requests[0].headers['X-Auth-Token'] == 'key/id'
+    assert search_bot.total == 25
+    assert search_bot.truncated == False
+
+def test_search_stops_at_max_results():
+    transport, requests = get_mock_search_api(25)
+
+    search_bot, results = run_search(transport, 10, 15)
+
+    assert sorted(int(request.url.params['start']) for request in requests) == [0, 10]
+    assert len(results) == 15
+    assert search_bot.total == 25
+    assert search_bot.truncated == True
+
+def test_search_fails_if_a_page_fails():
+    transport, requests = get_mock_search_api(25, failing_start=10)
+
+    search_bot, results = run_search(transport, 10, 100)
+
+    assert results == False
+
+def test_group_hits_by_host():
+    results = [{'deviceId': 1, 'processName': 'a.exe'},
+               {'deviceId': '1', 'processName': 'b.exe'},
+               {'deviceDetails': {'deviceId': 2}, 'eventType': 'NETWORK'},
+               {'deviceId': 9, 'processName': 'c.exe'}]
+
+    hosts = search.group_hits(results, [1, 2, 3], 1)
+
+    assert sorted(hosts) == [1, 2, 3]
+    assert hosts[1]['status'] == '2 hits.'
+    assert hosts[1]['hit_count'] == 2
+    assert hosts[1]['hits'] == [results[0]]
+    assert hosts[2]['hit_count'] == 1
+    assert hosts[3] == {'status': 'No hits.', 'hit_count': 0, 'hits': [], 'truncated': False}
+
+def test_group_hits_does_not_report_no_hits_when_truncated():
+    hosts = search.group_hits([{'deviceId': 1}], [1, 2], 10, truncated=True)
+
+    assert hosts[1]['status'] == 'At least 1 hits. Results were truncated.'
+    assert hosts[2]['status'] == 'No hits in the results read. Results were truncated.'
+    assert hosts[2]['truncated'] == True